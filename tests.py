@@ -1,9 +1,71 @@
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import struct
+import tempfile
+import time
 import unittest
 import datetime
 
 from PIL import Image, ImageDraw
 
-from tmstiler.rtm import RasterTileManager
+from tmstiler.rtm import RasterTileManager, get_time_range_bounds, get_time_frames
+from tmstiler.coverage import TileCoverageIndex
+from tmstiler.invalidation import DirtyTileSet
+from tmstiler.cache import SharedMemoryTileCache, DiskTileCache, TieredTileCache, InvalidCacheConfiguration
+from tmstiler.replay import TileReplayHarness, read_access_log, synthesize_sessions, percentile
+import tmstiler.prefetch
+from tmstiler.prefetch import TilePrefetcher, TileCacheMissing
+from tmstiler.profiling import TileProfiler
+from tmstiler.columnar import ColumnarLayerSource, ColumnMissing, UnsupportedFileFormat
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+try:
+    import django
+    from django.conf import settings
+    if not settings.configured:
+        # GDAL_LIBRARY_PATH/GEOS_LIBRARY_PATH may be given to locate the GIS libraries
+        databases = {}
+        if psycopg2 is not None:
+            # only used to compile queries, no connection is made
+            databases["default"] = {"ENGINE": "django.contrib.gis.db.backends.postgis", "NAME": "tmstiler_tests"}
+        settings.configure(GDAL_LIBRARY_PATH=os.environ.get("GDAL_LIBRARY_PATH"),
+                           GEOS_LIBRARY_PATH=os.environ.get("GEOS_LIBRARY_PATH"),
+                           DATABASES=databases,
+                           USE_TZ=False)
+    django.setup()
+    from django.contrib.gis.geos import GEOSGeometry, Point as GEOSPoint
+    from tmstiler.django import DjangoRasterTileLayerManager
+except Exception:
+    # django, or the GDAL/GEOS libraries, not available
+    DjangoRasterTileLayerManager = None
+
+PostGISMeasurement = None
+if DjangoRasterTileLayerManager is not None and psycopg2 is not None:
+    from django.contrib.gis.db import models
+
+    class PostGISMeasurement(models.Model):
+        location = models.PointField(srid=4326)
+        value = models.FloatField()
+        date = models.DateTimeField()
+        counts = models.IntegerField()
+
+        class Meta:
+            app_label = "tmstiler_tests"
 
 
 SPHERICAL_MERCATOR_SRID = 3857  # google maps projection
@@ -578,6 +640,1230 @@ class TestRasterTileManager(unittest.TestCase):
         msg = 'actual({}) != expected({})'.format(actual, expected)
         self.assertTrue(set(actual) == set(expected), msg)
 
+    def test_parse_url_time_range(self):
+        rtmgr = RasterTileManager()
+        url = "http://www.someserver.com/tiles/safecast/8/136/167.png?time=2014-10-01/2014-12-31"
+        self.assertTrue(rtmgr.parse_url(url) == ("safecast", 8, 136, 167, "png"))
+        actual = rtmgr.parse_url_time_range(url)
+        expected = ("2014-10-01", "2014-12-31")
+        msg = 'actual({}) != expected({})'.format(actual, expected)
+        self.assertTrue(actual == expected, msg)
+
+        url = "/tiles/safecast/8/136/167.png?time=2014-10-01"
+        self.assertTrue(rtmgr.parse_url_time_range(url) == ("2014-10-01", "2014-10-01"))
+        url = "/tiles/safecast/8/136/167.png"
+        self.assertTrue(rtmgr.parse_url_time_range(url) is None)
+
+    def test_get_time_range_bounds(self):
+        # date-only ends include the whole end day
+        actual = get_time_range_bounds(("2014-11-01", "2014-11-30"))
+        expected = ("2014-11-01", datetime.date(2014, 12, 1), False)
+        msg = 'actual({}) != expected({})'.format(actual, expected)
+        self.assertTrue(actual == expected, msg)
+        actual = get_time_range_bounds((datetime.date(2014, 11, 1), datetime.date(2014, 12, 31)))
+        expected = (datetime.date(2014, 11, 1), datetime.date(2015, 1, 1), False)
+        msg = 'actual({}) != expected({})'.format(actual, expected)
+        self.assertTrue(actual == expected, msg)
+        # datetime ends are kept, inclusive
+        end = datetime.datetime(2014, 11, 30, 12)
+        self.assertTrue(get_time_range_bounds(("2014-11-01", end)) == ("2014-11-01", end, True))
+        self.assertTrue(get_time_range_bounds(("2014-11-01", "2014-11-30T12:00")) == ("2014-11-01", "2014-11-30T12:00", True))
+
+    def test_get_time_frames(self):
+        actual = get_time_frames(("2014-11-15", "2015-01-01"), "month")
+        expected = [datetime.datetime(2014, 11, 1), datetime.datetime(2014, 12, 1), datetime.datetime(2015, 1, 1)]
+        msg = 'actual({}) != expected({})'.format(actual, expected)
+        self.assertTrue(actual == expected, msg)
+        actual = get_time_frames((datetime.date(2013, 6, 1), datetime.date(2014, 1, 1)), "year")
+        self.assertTrue(actual == [datetime.datetime(2013, 1, 1), datetime.datetime(2014, 1, 1)], actual)
+        actual = get_time_frames(("2014-11-30", "2014-12-01"), "day")
+        self.assertTrue(actual == [datetime.datetime(2014, 11, 30), datetime.datetime(2014, 12, 1)], actual)
+        # datetime ends are inclusive
+        actual = get_time_frames(("2014-11-30T22:30", datetime.datetime(2014, 12, 1)), "hour")
+        expected = [datetime.datetime(2014, 11, 30, 22), datetime.datetime(2014, 11, 30, 23), datetime.datetime(2014, 12, 1)]
+        msg = 'actual({}) != expected({})'.format(actual, expected)
+        self.assertTrue(actual == expected, msg)
+        with self.assertRaises(ValueError):
+            get_time_frames(("2014-11-01", "2014-11-30"), "week")
+
+    def test_parse_url_scale(self):
+        rtmgr = RasterTileManager()
+        url = "http://www.someserver.com/tiles/safecast/8/136/167@2x.png"
+        self.assertTrue(rtmgr.parse_url(url) == ("safecast", 8, 136, 167, "png"))
+        self.assertTrue(rtmgr.parse_url_scale(url) == 2)
+        url = "http://www.someserver.com/tiles/safecast/8/136/167.png"
+        self.assertTrue(rtmgr.parse_url_scale(url) == 1)
+
+    def test_sphericalmercator_to_pixel_tile_size(self):
+        zoom = 10
+        tilex = 911
+        tiley = 626
+        for tile_pixel_size, scale in ((256, 1), (512, 1), (256, 2), (512, 2)):
+            rtmgr = RasterTileManager(tile_pixels_width=tile_pixel_size, tile_pixels_height=tile_pixel_size)
+            expected_size = tile_pixel_size * scale
+            self.assertTrue(rtmgr.tile_pixels(scale) == (expected_size, expected_size))
+            xmin, ymin, xmax, ymax = rtmgr.tile_sphericalmercator_extent(zoom, tilex, tiley)
+            # upper-left
+            actual = rtmgr.sphericalmercator_to_pixel(zoom, tilex, tiley, xmin, ymax, scale=scale)
+            self.assertTrue(actual == (0, 0), 'actual({}) != expected({})'.format(actual, (0, 0)))
+            # center
+            center_x = xmin + (xmax - xmin)/2
+            center_y = ymin + (ymax - ymin)/2
+            actual = rtmgr.sphericalmercator_to_pixel(zoom, tilex, tiley, center_x, center_y, scale=scale)
+            expected = (expected_size // 2, expected_size // 2)
+            self.assertTrue(actual == expected, 'actual({}) != expected({})'.format(actual, expected))
+            # lower-right
+            actual = rtmgr.sphericalmercator_to_pixel(zoom, tilex, tiley, xmax, ymin, scale=scale)
+            expected = (expected_size, expected_size)
+            self.assertTrue(actual == expected, 'actual({}) != expected({})'.format(actual, expected))
+
+    def test_sphericalmercator_extent_to_tiles(self):
+        rtmgr = RasterTileManager()
+        zoom = 10
+        tilex = 911
+        tiley = 626
+        minx, miny, maxx, maxy = rtmgr.tile_sphericalmercator_extent(zoom, tilex, tiley)
+        center_x = minx + (maxx - minx)/2
+        center_y = miny + (maxy - miny)/2
+        actual = rtmgr.sphericalmercator_to_tile(zoom, center_x, center_y)
+        msg = 'actual({}) != expected({})'.format(actual, (tilex, tiley))
+        self.assertTrue(actual == (tilex, tiley), msg)
+
+        # extent slightly larger than the tile includes all 8 neighbors
+        actual = rtmgr.sphericalmercator_extent_to_tiles(zoom, minx - 1, miny - 1, maxx + 1, maxy + 1)
+        expected = rtmgr.get_neighbor_tiles(zoom, tilex, tiley) + [(tilex, tiley)]
+        msg = 'actual({}) != expected({})'.format(actual, expected)
+        self.assertTrue(set(actual) == set(expected), msg)
+
+
+class TestTileCoverageIndex(unittest.TestCase):
+
+    def test_covers(self):
+        rtmgr = RasterTileManager()
+        zoom = 10
+        tilex = 911
+        tiley = 626
+        minx, miny, maxx, maxy = rtmgr.tile_sphericalmercator_extent(zoom, tilex, tiley)
+        pixel_size_meters = 250
+        coverage_index = TileCoverageIndex(pixel_size_meters, zooms=(zoom - 1, zoom))
+        # point in the tile, near the left edge
+        coverage_index.add_point(minx + 10, miny + (maxy - miny)/2)
+
+        self.assertTrue(coverage_index.covers(zoom, tilex, tiley))
+        # left neighbor within the 1 pixel edge buffer
+        self.assertTrue(coverage_index.covers(zoom, tilex - 1, tiley))
+        self.assertFalse(coverage_index.covers(zoom, tilex + 1, tiley))
+        self.assertTrue(coverage_index.tile_count(zoom) == 2)
+        self.assertTrue(coverage_index.covers(zoom - 1, tilex // 2, tiley // 2))
+        # zoom levels above the indexed zoom levels are assumed to contain data
+        self.assertTrue(coverage_index.covers(zoom - 2, 0, 0))
+        # deeper zoom levels are checked against the ancestor tile at the deepest indexed zoom
+        self.assertTrue(coverage_index.covers(zoom + 2, tilex * 4, tiley * 4 + 3))
+        self.assertFalse(coverage_index.covers(zoom + 2, (tilex + 1) * 4, tiley * 4))
+        self.assertFalse(coverage_index.covers(zoom + 1, 0, 0))
+
+    def test_default_zooms(self):
+        rtmgr = RasterTileManager()
+        pixel_size_meters = 1500
+        coverage_index = TileCoverageIndex(pixel_size_meters)
+        # zoom 14 tiles are 2446m wide, zoom 15 tiles 1223m
+        self.assertTrue(sorted(coverage_index.tiles) == list(range(0, 15)), sorted(coverage_index.tiles))
+        xm, ym = 15556878.07, 4257415.63
+        coverage_index.add_point(xm, ym)
+        # the point's 1 pixel buffer spans at most 3 x 3 tiles per indexed zoom
+        self.assertTrue(all(coverage_index.tile_count(zoom) <= 9 for zoom in coverage_index.tiles))
+        for zoom in (10, 14, 17, 19):
+            tilex, tiley = rtmgr.sphericalmercator_to_tile(zoom, xm, ym)
+            self.assertTrue(coverage_index.covers(zoom, tilex, tiley), zoom)
+            self.assertFalse(coverage_index.covers(zoom, tilex + 2 ** max(zoom - 13, 1), tiley), zoom)
+
+    def test_dump_load(self):
+        coverage_index = TileCoverageIndex(1500, zooms=(3, 4))
+        coverage_index.add_points([(1289124.23, 6130077.43), (-9392582.03, 5009377.08)])
+        fileobj = io.StringIO()
+        coverage_index.dump(fileobj)
+        fileobj.seek(0)
+        loaded_index = TileCoverageIndex.load(fileobj)
+        self.assertTrue(loaded_index.pixel_size == coverage_index.pixel_size)
+        self.assertTrue(loaded_index.tiles == coverage_index.tiles)
+
+
+class TestDirtyTileSet(unittest.TestCase):
+
+    def test_add_extent(self):
+        rtmgr = RasterTileManager()
+        zoom = 10
+        tilex = 911
+        tiley = 626
+        minx, miny, maxx, maxy = rtmgr.tile_sphericalmercator_extent(zoom, tilex, tiley)
+        pixel_size_meters = 250
+        dirty_tiles = DirtyTileSet(zooms=(zoom - 1, zoom))
+        # pixel inside the tile
+        dirty_tiles.add_extent("layer", minx + 100, maxy - 100 - pixel_size_meters, minx + 100 + pixel_size_meters, maxy - 100)
+        # same pixel added twice
+        dirty_tiles.add_extent("layer", minx + 100, maxy - 100 - pixel_size_meters, minx + 100 + pixel_size_meters, maxy - 100)
+        expected = [("layer", zoom - 1, tilex // 2, tiley // 2), ("layer", zoom, tilex, tiley)]
+        actual = list(dirty_tiles)
+        msg = 'actual({}) != expected({})'.format(actual, expected)
+        self.assertTrue(actual == expected, msg)
+
+        # pixel touching the right edge of the tile is also drawn on the right neighbor
+        dirty_tiles.add_extent("layer", maxx - pixel_size_meters, miny + 100, maxx, miny + 100 + pixel_size_meters)
+        self.assertTrue(("layer", zoom, tilex + 1, tiley) in dirty_tiles.tiles)
+
+        # tilex(911) is odd, the tile's right edge is also a tile edge at zoom - 1
+        self.assertTrue(("layer", zoom - 1, tilex // 2 + 1, tiley // 2) in dirty_tiles.tiles)
+
+        actual = dirty_tiles.pop_all()
+        self.assertTrue(len(actual) == 4)
+        self.assertTrue(len(dirty_tiles) == 0)
+
+        # zooms deeper than max_zoom are not marked
+        dirty_tiles.add_extent("layer", minx + 100, miny + 100, minx + 200, miny + 200, max_zoom=zoom - 1)
+        self.assertTrue(list(dirty_tiles) == [("layer", zoom - 1, tilex // 2, tiley // 2)], list(dirty_tiles))
+
+
+def shared_cache_value(key, process_index):
+    # values of each process differ in content & length, a torn read mixes them
+    return "{}:{}".format(key, process_index).encode("utf8") * (10 * (process_index + 1))
+
+
+def shared_cache_worker(name, keys, process_index, process_count, iterations):
+    cache = SharedMemoryTileCache(name=name, slot_count=16, slot_size=1024)
+    errors = 0
+    try:
+        for _ in range(iterations):
+            for key in keys:
+                cache.set(key, shared_cache_value(key, process_index))
+                value = cache.get(key)
+                if value is not None and value not in {shared_cache_value(key, index) for index in range(process_count)}:
+                    errors += 1
+    finally:
+        cache.close()
+    os._exit(1 if errors else 0)
+
+
+class TestSharedMemoryTileCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = SharedMemoryTileCache(name="tmstiler-test-{}".format(os.getpid()), slot_count=16, slot_size=1024)
+
+    def tearDown(self):
+        self.cache.unlink()
+        self.cache.close()
+
+    def test_get_set(self):
+        key = "layer/8/136/167.png"
+        self.assertTrue(self.cache.get(key) is None)
+        self.assertTrue(self.cache.set(key, b"tile"))
+        self.assertTrue(self.cache.get(key) == b"tile")
+        self.assertTrue(self.cache.set(key, b"updated tile"))
+        self.assertTrue(self.cache.get(key) == b"updated tile")
+
+        # values larger than the slot are not cached
+        self.assertFalse(self.cache.set("layer/8/136/168.png", b"x" * 1024))
+        self.assertTrue(self.cache.get("layer/8/136/168.png") is None)
+
+        # expired values are not returned
+        self.cache.set("layer/8/136/169.png", b"tile", timeout=-1)
+        self.assertTrue(self.cache.get("layer/8/136/169.png") is None)
+
+        self.cache.delete(key)
+        self.assertTrue(self.cache.get(key) is None)
+
+    def test_killed_writer(self):
+        key = "layer/8/136/167.png"
+        self.cache.set(key, b"tile")
+        key_bytes = key.encode("utf8")
+        key_hash = self.cache._key_hash(key_bytes)
+        offset = [offset for offset in self.cache._bucket_offsets(key_hash)
+                  if self.cache._slot_holds_key(offset, key_hash, key_bytes)][0]
+        # writer killed after marking the slot as being written
+        sequence = struct.unpack_from(self.cache.SEQUENCE_FORMAT, self.cache.shm.buf, offset)[0]
+        struct.pack_into(self.cache.SEQUENCE_FORMAT, self.cache.shm.buf, offset, sequence + 1)
+        self.assertTrue(self.cache.get(key) is None)
+
+        # the next write of the slot recovers it
+        for value in (b"tile 1", b"tile 2", b"tile 3"):
+            self.assertTrue(self.cache.set(key, value))
+            self.assertTrue(self.cache.get(key) == value)
+            sequence = struct.unpack_from(self.cache.SEQUENCE_FORMAT, self.cache.shm.buf, offset)[0]
+            self.assertTrue(sequence % 2 == 0, sequence)
+
+        # a slot left odd can also be deleted
+        sequence = struct.unpack_from(self.cache.SEQUENCE_FORMAT, self.cache.shm.buf, offset)[0]
+        struct.pack_into(self.cache.SEQUENCE_FORMAT, self.cache.shm.buf, offset, sequence + 1)
+        self.cache.delete(key)
+        self.assertTrue(self.cache.get(key) is None)
+        self.assertTrue(self.cache.set(key, b"tile"))
+        self.assertTrue(self.cache.get(key) == b"tile")
+
+    def test_shared(self):
+        key = "layer/8/136/167.png"
+        self.cache.set(key, b"tile")
+        attached_cache = SharedMemoryTileCache(name=self.cache.name, slot_count=16, slot_size=1024)
+        self.assertTrue(attached_cache.get(key) == b"tile")
+        attached_cache.close()
+
+    @unittest.skipUnless("fork" in multiprocessing.get_all_start_methods(), "fork not available")
+    def test_multiprocess(self):
+        # processes writing & reading the same slots concurrently only read complete values
+        keys = ["layer/8/136/{}.png".format(y) for y in range(8)]
+        process_count = 4
+        context = multiprocessing.get_context("fork")
+        processes = [context.Process(target=shared_cache_worker,
+                                     args=(self.cache.name, keys, process_index, process_count, 200))
+                     for process_index in range(process_count)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(30)
+        actual = [process.exitcode for process in processes]
+        self.assertTrue(actual == [0] * process_count, actual)
+        for key in keys:
+            value = self.cache.get(key)
+            valid_values = {shared_cache_value(key, index) for index in range(process_count)}
+            self.assertTrue(value is None or value in valid_values, (key, value))
+        self.assertTrue(any(self.cache.get(key) is not None for key in keys))
+
+    @unittest.skipUnless(os.path.isdir("/dev/shm"), "/dev/shm not available")
+    def test_shared_memory_space(self):
+        stat = os.statvfs("/dev/shm")
+        slot_count = (stat.f_bavail * stat.f_frsize) // 1024 + 1
+        name = "tmstiler-test-large-{}".format(os.getpid())
+        lock_path = os.path.join(tempfile.gettempdir(), "{}.lock".format(name))
+        self.addCleanup(os.remove, lock_path)
+        with self.assertRaises(InvalidCacheConfiguration):
+            SharedMemoryTileCache(name=name, slot_count=slot_count, slot_size=1024, lock_path=lock_path)
+        self.assertFalse(os.path.exists(os.path.join("/dev/shm", name)))
+
+    def test_eviction(self):
+        keys = ["layer/8/{}/167.png".format(x) for x in range(100)]
+        for key in keys:
+            self.cache.set(key, key.encode("utf8"))
+        cached_values = [self.cache.get(key) for key in keys]
+        self.assertTrue(all(value == key.encode("utf8") for key, value in zip(keys, cached_values) if value))
+        self.assertTrue(sum(1 for value in cached_values if value) <= 16)
+        # last value set is always cached
+        self.assertTrue(cached_values[-1] == keys[-1].encode("utf8"))
+
+
+class TestDiskTileCache(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_get_set(self):
+        cache = DiskTileCache(self.root)
+        key = "layer/8/136/167.png"
+        self.assertTrue(cache.get(key) is None)
+        self.assertTrue(cache.get_path(key) is None)
+        cache.set(key, b"tile")
+        self.assertTrue(cache.get(key) == b"tile")
+        expected_path = os.path.join(self.root, "layer", "8", "136", "167.png")
+        self.assertTrue(cache.get_path(key) == expected_path)
+        cache.delete(key)
+        self.assertTrue(cache.get(key) is None)
+        self.assertFalse(os.path.exists(expected_path))
+        self.assertRaises(ValueError, cache.get, "layer/../../167.png")
+        cache.close()
+
+    def test_file_mode(self):
+        umask = os.umask(0o022)
+        try:
+            cache = DiskTileCache(self.root)
+            cache.set("layer/8/136/167.png", b"tile")
+            mode = os.stat(cache.get_path("layer/8/136/167.png")).st_mode & 0o777
+            self.assertTrue(mode == 0o644, oct(mode))
+            cache.close()
+        finally:
+            os.umask(umask)
+
+    def test_eviction(self):
+        cache = DiskTileCache(self.root, max_size=1000)
+        cache.set("layer/8/136/167.png", b"x" * 400)
+        cache.set("layer/8/136/168.png", b"x" * 400)
+        # access first tile, so the second is the least recently accessed
+        time.sleep(0.01)
+        self.assertTrue(cache.get("layer/8/136/167.png") is not None)
+        cache.set("layer/8/136/169.png", b"x" * 400)
+        self.assertTrue(cache.get("layer/8/136/167.png") is not None)
+        self.assertTrue(cache.get("layer/8/136/168.png") is None)
+        self.assertTrue(cache.get("layer/8/136/169.png") is not None)
+        cache.close()
+
+    def test_timeout(self):
+        cache = DiskTileCache(self.root, timeout=-1)
+        cache.set("layer/8/136/167.png", b"tile")
+        self.assertTrue(cache.get("layer/8/136/167.png") is None)
+        cache.close()
+
+    def test_tiered_warm(self):
+        disk_cache = DiskTileCache(self.root)
+        disk_cache.set("layer/8/136/167.png", b"tile")
+        disk_cache.set("layer/8/136/168.png", b"tile")
+        memory_cache = SharedMemoryTileCache(name="tmstiler-test-{}".format(os.getpid()), slot_count=16, slot_size=1024)
+        try:
+            self.assertTrue(disk_cache.warm(memory_cache) == 2)
+            self.assertTrue(memory_cache.get("layer/8/136/168.png") == b"tile")
+
+            tiered_cache = TieredTileCache(memory_cache, disk_cache)
+            disk_cache.set("layer/8/136/169.png", b"tile")
+            self.assertTrue(memory_cache.get("layer/8/136/169.png") is None)
+            self.assertTrue(tiered_cache.get("layer/8/136/169.png") == b"tile")
+            # copied to the memory cache on read
+            self.assertTrue(memory_cache.get("layer/8/136/169.png") == b"tile")
+        finally:
+            memory_cache.unlink()
+            memory_cache.close()
+            disk_cache.close()
+
+
+class DummyTileCache:
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def set(self, key, value):
+        self.values[key] = value
+
+
+class DummyTileLayerManager(RasterTileManager):
+
+    def __init__(self):
+        super().__init__()
+        self.tile_cache = DummyTileCache()
+        self.prefetcher = None
+
+    def get_tile_cache_key(self, layername, zoom, tilex, tiley, extension=".png", scale=1):
+        return "{}/{}/{}/{}{}".format(layername, zoom, tilex, tiley, extension)
+
+    def render_tile(self, layername, zoom, tilex, tiley, extension=".png", scale=1):
+        tile_bytes = b"tile"
+        self.tile_cache.set(self.get_tile_cache_key(layername, zoom, tilex, tiley, extension), tile_bytes)
+        return "image/png", tile_bytes
+
+    def get_encoded_tile(self, layername, zoom, tilex, tiley, extension=".png", scale=1):
+        tile_bytes = self.tile_cache.get(self.get_tile_cache_key(layername, zoom, tilex, tiley, extension))
+        if self.prefetcher is not None:
+            self.prefetcher.schedule(layername, zoom, tilex, tiley, extension)
+        if tile_bytes is None:
+            return self.render_tile(layername, zoom, tilex, tiley, extension)
+        return "image/png", tile_bytes
+
+
+class TestTileReplayHarness(unittest.TestCase):
+
+    def test_read_access_log(self):
+        log = io.StringIO('127.0.0.1 - - [10/Oct/2016:13:55:36 +0900] "GET /tiles/safecast/8/136/167.png HTTP/1.1" 200 2326\n'
+                          '127.0.0.1 - - [10/Oct/2016:13:55:37 +0900] "GET /static/app.js HTTP/1.1" 200 1000\n'
+                          'invalid line\n')
+        actual = read_access_log(log, path_filter=r"\.png$")
+        expected = ["/tiles/safecast/8/136/167.png"]
+        msg = 'actual({}) != expected({})'.format(actual, expected)
+        self.assertTrue(actual == expected, msg)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertTrue(percentile(values, 50) == 50)
+        self.assertTrue(percentile(values, 99) == 99)
+        self.assertTrue(percentile([], 50) is None)
+
+    def test_run(self):
+        tilemgr = DummyTileLayerManager()
+        hotspots = [(139.6917, 35.6895, 10), (140.4748, 37.7608, 1)]
+        urls = synthesize_sessions(tilemgr, "safecast", hotspots, {10: 5, 12: 1}, session_count=5, seed=1)
+        self.assertTrue(len(urls) == 5 * 10 * 9)
+        for url in urls:
+            layername, zoom, tilex, tiley, image_format = tilemgr.parse_url(url)
+            max_tiles, _ = tilemgr.tiles_per_dimension(zoom)
+            self.assertTrue(0 <= tilex < max_tiles and 0 <= tiley < max_tiles)
+
+        harness = TileReplayHarness(tilemgr, concurrency=2, count_queries=False)
+        report = harness.run(urls)
+        self.assertTrue(report.request_count == len(urls))
+        self.assertFalse(report.errors)
+        self.assertTrue(report.cache_hits + report.cache_misses == len(urls))
+        # concurrent requests for the same tile may both miss
+        self.assertTrue(report.cache_misses >= len(set(urls)))
+        self.assertTrue(isinstance(tilemgr.tile_cache, DummyTileCache))
+        self.assertTrue(report.format())
+
+    def test_run_prefetcher_lookups_not_counted(self):
+        tilemgr = DummyTileLayerManager()
+        tilemgr.prefetcher = TilePrefetcher(tilemgr, workers=2, include_children=True)
+        try:
+            hotspots = [(139.6917, 35.6895, 1)]
+            urls = synthesize_sessions(tilemgr, "safecast", hotspots, {10: 1}, session_count=3, seed=1)
+            report = TileReplayHarness(tilemgr, concurrency=2, count_queries=False).run(urls)
+        finally:
+            tilemgr.prefetcher.stop(timeout=5)
+        self.assertFalse(report.errors)
+        # only the replayed requests' lookups are counted, not the prefetcher's
+        lookups = report.cache_hits + report.cache_misses
+        self.assertTrue(lookups == len(urls), (lookups, len(urls)))
+
+
+class TestTilePrefetcher(unittest.TestCase):
+
+    def wait_for_cached(self, tilemgr, expected_keys, timeout=5):
+        end = time.time() + timeout
+        while time.time() < end:
+            if all(tilemgr.tile_cache.get(key) is not None for key in expected_keys):
+                return True
+            time.sleep(0.01)
+        return False
+
+    def test_schedule(self):
+        tilemgr = DummyTileLayerManager()
+        prefetcher = TilePrefetcher(tilemgr, include_children=True)
+        try:
+            zoom = 7
+            tilex = 119
+            tiley = 0
+            expected_keys = [tilemgr.get_tile_cache_key("layer", zoom, x, y)
+                             for x, y in tilemgr.get_neighbor_tiles(zoom, tilex, tiley)]
+            expected_keys.extend(tilemgr.get_tile_cache_key("layer", zoom + 1, x, y)
+                                 for x, y in tilemgr.get_child_tiles(zoom, tilex, tiley))
+            self.assertTrue(len(expected_keys) == 5 + 4)
+
+            # workers wait for foreground requests to complete
+            with prefetcher.foreground():
+                prefetcher.schedule("layer", zoom, tilex, tiley)
+                time.sleep(0.05)
+                self.assertFalse(tilemgr.tile_cache.values)
+            self.assertTrue(self.wait_for_cached(tilemgr, expected_keys))
+        finally:
+            prefetcher.stop(timeout=5)
+
+    def test_bounded_queue_cancel(self):
+        tilemgr = DummyTileLayerManager()
+        prefetcher = TilePrefetcher(tilemgr, max_queue_size=10)
+        try:
+            with prefetcher.foreground():
+                prefetcher.schedule("layer", 11, 1893, 15)
+                prefetcher.schedule("layer", 11, 1893, 15)
+                self.assertTrue(len(prefetcher.pending) == 8)
+                prefetcher.schedule("other", 11, 100, 100)
+                self.assertTrue(len(prefetcher.pending) == 10)
+                prefetcher.cancel("other")
+                self.assertTrue(all(tile[0] == "layer" for tile in prefetcher.pending))
+                prefetcher.cancel()
+                self.assertFalse(prefetcher.pending)
+        finally:
+            prefetcher.stop(timeout=5)
+
+    def test_tile_cache_missing(self):
+        tilemgr = DummyTileLayerManager()
+        tilemgr.tile_cache = None
+        with self.assertRaises(TileCacheMissing):
+            TilePrefetcher(tilemgr)
+
+    def test_worker_errors(self):
+        tilemgr = DummyTileLayerManager()
+        failing_key = tilemgr.get_tile_cache_key("layer", 7, 120, 0)
+
+        class FailingTileCache(DummyTileCache):
+
+            def get(self, key, default=None):
+                if key == failing_key:
+                    raise ConnectionError("cache unavailable")
+                return super().get(key, default)
+
+        tilemgr.tile_cache = FailingTileCache()
+        close_count = []
+        original_close_old_connections = tmstiler.prefetch.close_old_connections
+        tmstiler.prefetch.close_old_connections = lambda: close_count.append(1)
+        self.addCleanup(setattr, tmstiler.prefetch, "close_old_connections", original_close_old_connections)
+        prefetcher = TilePrefetcher(tilemgr)
+        try:
+            expected_keys = [tilemgr.get_tile_cache_key("layer", 7, x, y) for x, y in tilemgr.get_neighbor_tiles(7, 119, 0)]
+            expected_keys.remove(failing_key)
+            # the failed cache lookup is logged, and the worker continues with the next tiles
+            with self.assertLogs("tmstiler.prefetch", "ERROR"):
+                prefetcher.schedule("layer", 7, 119, 0)
+                self.assertTrue(self.wait_for_cached(tilemgr, expected_keys))
+        finally:
+            prefetcher.stop(timeout=5)
+        # connections are checked before & after each render
+        self.assertTrue(len(close_count) == 2 * len(expected_keys), len(close_count))
+
+    def test_get_child_tiles(self):
+        rtmgr = RasterTileManager()
+        actual = rtmgr.get_child_tiles(6, 16, 40)
+        expected = [(32, 80), (32, 81), (33, 80), (33, 81)]
+        msg = 'actual({}) != expected({})'.format(actual, expected)
+        self.assertTrue(actual == expected, msg)
+        # children cover the parent extent
+        parent_extent = rtmgr.tile_sphericalmercator_extent(6, 16, 40)
+        child_extents = [rtmgr.tile_sphericalmercator_extent(7, x, y) for x, y in actual]
+        self.assertTrue(round(min(e[0] for e in child_extents), 2) == round(parent_extent[0], 2))
+        self.assertTrue(round(max(e[3] for e in child_extents), 2) == round(parent_extent[3], 2))
+
+
+class TestTileProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def capture_files(self, extension):
+        return sorted(filename for filename in os.listdir(self.directory) if filename.endswith(extension))
+
+    def test_threshold_capture(self):
+        profiler = TileProfiler(self.directory, threshold=0.05, sample_interval=0.005)
+        self.addCleanup(profiler.close)
+        with profiler.capture("layer", 10, 1, 2) as capture:
+            capture.row_count = 3
+            capture.query = ("SELECT 1", [])
+        self.assertFalse(os.listdir(self.directory))
+
+        with profiler.capture("layer", 10, 1, 2) as capture:
+            self.assertTrue(profiler.current() is capture)
+            capture.row_count = 3
+            capture.query = ("SELECT 1", [])
+            time.sleep(0.2)
+        self.assertTrue(profiler.current() is None)
+        json_files = self.capture_files(".json")
+        self.assertTrue(len(json_files) == 1, json_files)
+        with open(os.path.join(self.directory, json_files[0])) as details_file:
+            details = json.load(details_file)
+        self.assertTrue(details["row_count"] == 3)
+        self.assertTrue(details["sql"].startswith("SELECT 1"))
+        self.assertTrue(details["elapsed"] >= 0.2)
+        self.assertTrue(details["stack_samples"] > 0)
+        folded_files = self.capture_files(".folded")
+        self.assertTrue(len(folded_files) == 1, folded_files)
+        with open(os.path.join(self.directory, folded_files[0])) as folded_file:
+            self.assertTrue("test_threshold_capture" in folded_file.read())
+
+    def test_watchdog_thread(self):
+        profiler = TileProfiler(self.directory, threshold=0.05, sample_interval=0.005)
+        # the watchdog thread is started on the first render
+        self.assertTrue(profiler._watchdog is None)
+        with profiler.capture("layer", 10, 1, 2):
+            pass
+        watchdog = profiler._watchdog
+        self.assertTrue(watchdog.is_alive())
+        profiler.close()
+        self.assertFalse(watchdog.is_alive())
+        # renders are still captured after close(), without stack samples
+        with profiler.capture("layer", 10, 1, 2):
+            time.sleep(0.1)
+        self.assertTrue(len(self.capture_files(".json")) == 1)
+        self.assertFalse(self.capture_files(".folded"))
+
+        # no watchdog thread without a threshold
+        profiler = TileProfiler(self.directory, threshold=None)
+        with profiler.capture("layer", 10, 1, 2):
+            pass
+        self.assertTrue(profiler._watchdog is None)
+        profiler.close()
+
+    def test_sampled_capture_rotation(self):
+        profiler = TileProfiler(self.directory, threshold=None, sample_rate=1.0, max_captures=2)
+        for tilex in range(4):
+            with profiler.capture("layer", 10, tilex, 2):
+                sum(range(1000))
+        json_files = self.capture_files(".json")
+        self.assertTrue(len(json_files) == 2, json_files)
+        # the most recent captures are kept
+        self.assertTrue(json_files[0].endswith("_layer_10_2_2.json"), json_files)
+        self.assertTrue(json_files[1].endswith("_layer_10_3_2.json"), json_files)
+        self.assertTrue(len(self.capture_files(".prof")) == 2)
+
+
+@unittest.skipUnless(numpy is not None, "numpy not installed")
+class TestColumnarLayerSource(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        # 100 x 100 grid of 1000m bins, sorted by x so that each 1000 row chunk covers a 10 bin column strip
+        grid_xs, grid_ys = numpy.meshgrid(numpy.arange(100) * 1000.0, numpy.arange(100) * 1000.0, indexing="ij")
+        self.xs = grid_xs.ravel()
+        self.ys = grid_ys.ravel()
+        self.values = numpy.arange(len(self.xs), dtype=numpy.float64)
+        self.times = numpy.datetime64("2020-01-01T00:00:00") + (numpy.arange(len(self.xs)) % 10).astype("timedelta64[D]")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def check_source(self, source):
+        self.assertTrue(source.chunk_count == 10, source.chunk_count)
+        self.assertTrue(source.chunk_bounds[1] == (10000.0, 0.0, 19000.0, 99000.0), source.chunk_bounds[1])
+        self.assertTrue(source.intersecting_chunks(15000, 0, 25000, 5000) == [1, 2])
+
+        chunks = list(source.query(15000, 2000, 25000, 5000))
+        self.assertTrue(len(chunks) == 2)
+        actual = sorted((x, y, value) for xs, ys, values, _ in chunks
+                        for x, y, value in zip(xs.tolist(), ys.tolist(), values.tolist()))
+        mask = (self.xs >= 15000) & (self.xs <= 25000) & (self.ys >= 2000) & (self.ys <= 5000)
+        expected = sorted(zip(self.xs[mask].tolist(), self.ys[mask].tolist(), self.values[mask].tolist()))
+        msg = 'actual({}) != expected({})'.format(actual, expected)
+        self.assertTrue(actual == expected, msg)
+
+        # times in the extent are 2020-01-03 to 2020-01-06
+        time_range = (datetime.datetime(2020, 1, 4), datetime.datetime(2020, 1, 5))
+        chunks = list(source.query(15000, 2000, 25000, 5000, time_range=time_range))
+        actual_times = set(time for _, _, _, times in chunks for time in times.astype("datetime64[us]").tolist())
+        self.assertTrue(actual_times == {datetime.datetime(2020, 1, 4), datetime.datetime(2020, 1, 5)}, actual_times)
+
+        # a date-only end includes all of the end day
+        time_range = ("2020-01-04", "2020-01-05")
+        chunks = list(source.query(15000, 2000, 25000, 5000, time_range=time_range))
+        actual_times = set(time for _, _, _, times in chunks for time in times.astype("datetime64[us]").tolist())
+        self.assertTrue(actual_times == {datetime.datetime(2020, 1, 4), datetime.datetime(2020, 1, 5)}, actual_times)
+
+        self.assertFalse(list(source.query(500000, 500000, 600000, 600000)))
+        self.assertTrue(len(list(source.iter_points())) == len(self.xs))
+
+    def test_npz(self):
+        path = os.path.join(self.directory, "layer.npz")
+        numpy.savez(path, x=self.xs, y=self.ys, value=self.values, time=self.times)
+        source = ColumnarLayerSource(path, time_column="time", npz_chunk_rows=1000)
+        self.check_source(source)
+
+    @unittest.skipUnless(pyarrow is not None, "pyarrow not installed")
+    def test_parquet(self):
+        path = os.path.join(self.directory, "layer.parquet")
+        table = pyarrow.table({"x": self.xs, "y": self.ys, "value": self.values, "time": self.times})
+        pyarrow.parquet.write_table(table, path, row_group_size=1000)
+        source = ColumnarLayerSource(path, time_column="time")
+        self.check_source(source)
+
+    @unittest.skipUnless(pyarrow is not None, "pyarrow not installed")
+    def test_arrow_ipc(self):
+        path = os.path.join(self.directory, "layer.arrow")
+        table = pyarrow.table({"x": self.xs, "y": self.ys, "value": self.values, "time": self.times})
+        with pyarrow.ipc.new_file(path, table.schema) as writer:
+            writer.write_table(table, max_chunksize=1000)
+        source = ColumnarLayerSource(path, time_column="time")
+        self.check_source(source)
+
+    def test_date_only_time_range_end(self):
+        path = os.path.join(self.directory, "layer.npz")
+        times = numpy.array(["2014-10-31T23:00", "2014-11-01T00:00", "2014-11-30T12:00", "2014-12-01T00:00"],
+                            dtype="datetime64[s]")
+        numpy.savez(path, x=numpy.zeros(4), y=numpy.zeros(4), value=numpy.arange(4.0), time=times)
+        source = ColumnarLayerSource(path, time_column="time")
+        for time_range in (("2014-11-01", "2014-11-30"), (datetime.date(2014, 11, 1), datetime.date(2014, 11, 30))):
+            actual = [value for _, _, values, _ in source.query(-1, -1, 1, 1, time_range=time_range)
+                      for value in values.tolist()]
+            self.assertTrue(actual == [1.0, 2.0], actual)
+        actual = [value for _, _, values, _ in source.query(-1, -1, 1, 1, time_range=("2014-11-01", "2014-11-30T11:00"))
+                  for value in values.tolist()]
+        self.assertTrue(actual == [1.0], actual)
+
+    @unittest.skipUnless(pyarrow is not None, "pyarrow not installed")
+    def test_null_times(self):
+        # null parquet timestamps are read as NaT
+        path = os.path.join(self.directory, "layer.parquet")
+        times = [datetime.datetime(2014, 11, 1), None, datetime.datetime(2014, 11, 2)]
+        table = pyarrow.table({"x": [0.0, 0.0, 0.0], "y": [0.0, 0.0, 0.0], "value": [1.0, 2.0, 3.0],
+                               "time": pyarrow.array(times, pyarrow.timestamp("us"))})
+        pyarrow.parquet.write_table(table, path)
+        source = ColumnarLayerSource(path, time_column="time")
+        for time_range in (None, ("2014-11-01", "2014-11-30")):
+            actual = [value for _, _, values, _ in source.query(-1, -1, 1, 1, time_range=time_range)
+                      for value in values.tolist()]
+            self.assertTrue(actual == [1.0, 3.0], (time_range, actual))
+        # all values are kept when the layer is not temporal
+        source = ColumnarLayerSource(path)
+        actual = [value for _, _, values, _ in source.query(-1, -1, 1, 1) for value in values.tolist()]
+        self.assertTrue(actual == [1.0, 2.0, 3.0], actual)
+
+    def test_invalid_files(self):
+        path = os.path.join(self.directory, "layer.npz")
+        numpy.savez(path, x=self.xs, y=self.ys)
+        with self.assertRaises(ColumnMissing):
+            ColumnarLayerSource(path)
+        with self.assertRaises(UnsupportedFileFormat):
+            ColumnarLayerSource(os.path.join(self.directory, "layer.csv"))
+
+
+class DummyQuerySet:
+    """
+    Minimal model queryset, evaluating the 'within', 'bboverlaps', 'gte', 'lte' and 'lt' lookups in python
+    """
+
+    def __init__(self, instances, only_fieldnames=None):
+        self.instances = list(instances)
+        self.query = "SELECT * FROM dummy"
+        self.db = "default"
+        self.lookups = {}
+        # shared with the filtered querysets to record the 'only()' field names
+        self.only_fieldnames = only_fieldnames if only_fieldnames is not None else []
+
+    def filter(self, **kwargs):
+        instances = self.instances
+        for lookup, lookup_value in kwargs.items():
+            fieldname, lookup_type = lookup.split("__")
+            if lookup_type == "within":
+                instances = [i for i in instances if getattr(i, fieldname).within(lookup_value)]
+            elif lookup_type == "bboverlaps":
+                minx, miny, maxx, maxy = lookup_value.extent
+                instances = [i for i in instances
+                             if minx <= getattr(i, fieldname).x <= maxx and miny <= getattr(i, fieldname).y <= maxy]
+            elif lookup_type == "gte":
+                instances = [i for i in instances if getattr(i, fieldname) >= lookup_value]
+            elif lookup_type == "lte":
+                instances = [i for i in instances if getattr(i, fieldname) <= lookup_value]
+            elif lookup_type == "lt":
+                instances = [i for i in instances if getattr(i, fieldname) < lookup_value]
+            else:
+                raise ValueError(lookup)
+        queryset = DummyQuerySet(instances, self.only_fieldnames)
+        queryset.lookups = dict(self.lookups, **kwargs)
+        return queryset
+
+    def only(self, *fieldnames):
+        self.only_fieldnames.extend(fieldnames)
+        return self
+
+    def __iter__(self):
+        # instances are copied, points are transformed in place
+        for instance in self.instances:
+            location = GEOSPoint(instance.location.x, instance.location.y, srid=instance.location.srid)
+            yield DummyMeasurement(location, instance.date, instance.counts, instance.value)
+
+
+class QueryFailingQuerySet(DummyQuerySet):
+
+    def filter(self, **kwargs):
+        raise AssertionError("layer queried")
+
+
+class DjangoLegend:
+
+    def __init__(self, color_str="hsl(0,100%,50%)"):
+        self.color_str = color_str
+
+    def get_color_str(self, model_instance, model_value_fieldname="value"):
+        return self.color_str
+
+
+@unittest.skipUnless(DjangoRasterTileLayerManager is not None, "django GIS not available")
+class TestDjangoRasterTileLayerManager(unittest.TestCase):
+
+    def get_tilemgr(self, points, point_position="upperleft", pixel_size=100, query_strategy="within", **kwargs):
+        measurements = [DummyMeasurement(GEOSPoint(x, y, srid=SPHERICAL_MERCATOR_SRID), None, 1, 1.0)
+                        for x, y in points]
+        layers = {"layer": {"pixel_size": pixel_size,
+                            "point_position": point_position,
+                            "model_queryset": DummyQuerySet(measurements),
+                            "model_point_fieldname": "location",
+                            "model_value_fieldname": "value",
+                            "legend_instance": DjangoLegend(),
+                            "query_strategy": query_strategy}}
+        return DjangoRasterTileLayerManager(layers, **kwargs)
+
+    def test_get_upperleft_offset(self):
+        expected_offsets = {"upperleft": (0.0, 0.0),
+                            "upperright": (-100.0, 0.0),
+                            "lowerleft": (0.0, 100.0),
+                            "lowerright": (-100.0, 100.0),
+                            "center": (-50.0, 50.0)}
+        for point_position, expected in expected_offsets.items():
+            tilemgr = self.get_tilemgr([], point_position=point_position)
+            actual = tilemgr._get_upperleft_offset("layer")
+            msg = '{}: actual({}) != expected({})'.format(point_position, actual, expected)
+            self.assertTrue(actual == expected, msg)
+
+    def test_get_pixel_extent(self):
+        expected_extents = {"upperleft": (1000.0, 1900.0, 1100.0, 2000.0),
+                            "upperright": (900.0, 1900.0, 1000.0, 2000.0),
+                            "lowerleft": (1000.0, 2000.0, 1100.0, 2100.0),
+                            "lowerright": (900.0, 2000.0, 1000.0, 2100.0),
+                            "center": (950.0, 1950.0, 1050.0, 2050.0)}
+        for point_position, expected in expected_extents.items():
+            tilemgr = self.get_tilemgr([], point_position=point_position)
+            actual = tilemgr.get_pixel_extent("layer", 1000.0, 2000.0)
+            msg = '{}: actual({}) != expected({})'.format(point_position, actual, expected)
+            self.assertTrue(actual == expected, msg)
+
+    def test_pixel_bbox_outside_tile(self):
+        zoom, tilex, tiley = 10, 911, 626
+        tilemgr = self.get_tilemgr([])
+        tile_xmin, tile_ymin, tile_xmax, tile_ymax = tilemgr.tile_sphericalmercator_extent(zoom, tilex, tiley)
+        meters_per_pixel = tilemgr._get_meters_per_pixel(zoom, tilex, tiley)
+        # "center" pixel starting 130m left of the tile, drawn entirely outside the tile
+        xm = tile_xmin - 80
+        ym = (tile_ymin + tile_ymax) / 2
+        tilemgr = self.get_tilemgr([(xm, ym)], point_position="center")
+        actual = [pixel_bbox for pixel_bbox, _ in tilemgr._get_tile_pixels("layer", zoom, tilex, tiley)]
+        self.assertTrue(len(actual) == 1, actual)
+        pixel_xmin, _, pixel_xmax, _ = actual[0]
+        self.assertTrue(pixel_xmin == -1 and pixel_xmax == -1, actual)
+        self.assertTrue(meters_per_pixel > 130)
+
+        _, tile_image = tilemgr.get_tile("layer", zoom, tilex, tiley)
+        self.assertFalse(any(tile_image.getpixel((0, y))[3] for y in range(tile_image.height)))
+
+    def test_get_layer_queryset_time_range(self):
+        dates = [datetime.date(2014, 10, 31), datetime.date(2014, 11, 1), datetime.date(2014, 11, 30),
+                 datetime.date(2014, 12, 1)]
+        measurements = [DummyMeasurement(GEOSPoint(0, 0, srid=SPHERICAL_MERCATOR_SRID), date, 1, 1.0)
+                        for date in dates]
+        layers = {"layer": {"pixel_size": 100,
+                            "point_position": "upperleft",
+                            "model_queryset": DummyQuerySet(measurements),
+                            "model_point_fieldname": "location",
+                            "model_value_fieldname": "value",
+                            "model_time_fieldname": "date",
+                            "legend_instance": DjangoLegend()}}
+        tilemgr = DjangoRasterTileLayerManager(layers)
+        queryset = tilemgr._get_layer_queryset("layer", (datetime.date(2014, 11, 1), datetime.date(2014, 11, 30)))
+        expected = {"date__gte": datetime.date(2014, 11, 1), "date__lt": datetime.date(2014, 12, 1)}
+        msg = 'actual({}) != expected({})'.format(queryset.lookups, expected)
+        self.assertTrue(queryset.lookups == expected, msg)
+        actual = [measurement.date for measurement in queryset.instances]
+        self.assertTrue(actual == dates[1:3], actual)
+
+        # only the lookups are checked
+        layers["layer"]["model_queryset"] = DummyQuerySet([])
+        end = datetime.datetime(2014, 11, 30, 12)
+        queryset = tilemgr._get_layer_queryset("layer", ("2014-11-01", end))
+        self.assertTrue(queryset.lookups == {"date__gte": "2014-11-01", "date__lte": end}, queryset.lookups)
+
+    def test_model_only_fields(self):
+        zoom, tilex, tiley = 10, 911, 626
+        tilemgr = self.get_tilemgr([])
+        layer_config = tilemgr.layers_config["layer"]
+        layer_config["model_only_fields"] = ["counts", "location"]
+        layer_config["model_time_fieldname"] = "date"
+        list(tilemgr._get_tile_pixels("layer", zoom, tilex, tiley))
+        actual = layer_config["model_queryset"].only_fieldnames
+        expected = ["counts", "location", "value", "date"]
+        self.assertTrue(actual == expected, 'actual({}) != expected({})'.format(actual, expected))
+
+    @unittest.skipUnless(PostGISMeasurement is not None, "psycopg2 not available")
+    def test_get_raw_tile_query(self):
+        zoom, tilex, tiley = 10, 911, 626
+        layers = {"layer": {"pixel_size": 100,
+                            "point_position": "center",
+                            "model_queryset": PostGISMeasurement.objects.filter(counts__gt=0),
+                            "model_point_fieldname": "location",
+                            "model_value_fieldname": "value",
+                            "legend_instance": DjangoLegend(),
+                            "query_strategy": "raw"}}
+        tilemgr = DjangoRasterTileLayerManager(layers)
+        tile_xmin, tile_ymin, tile_xmax, tile_ymax = tilemgr.tile_sphericalmercator_extent(zoom, tilex, tiley)
+        meters_per_pixel = tilemgr._get_meters_per_pixel(zoom, tilex, tiley, 1)
+        sql, params, row_fieldnames = tilemgr._get_raw_tile_query("layer", zoom, tilex, tiley)
+        self.assertTrue(row_fieldnames == ["value"], row_fieldnames)
+        self.assertTrue(sql.startswith('SELECT (ST_X(ST_Transform(t."location"::geometry, %s)) + %s - %s) / %s, '
+                                       '(%s - (ST_Y(ST_Transform(t."location"::geometry, %s)) + %s)) / %s, '
+                                       't."value" FROM (SELECT '), sql)
+        # the queryset filters & the bounding box overlap test are applied in the subquery, on the model column
+        self.assertTrue('"tmstiler_tests_postgismeasurement"."counts" > %s' in sql, sql)
+        self.assertTrue('"tmstiler_tests_postgismeasurement"."location" && ST_Transform(%s, 4326)' in sql, sql)
+        self.assertTrue(sql.count("%s") == len(params), (sql, params))
+        expected = [SPHERICAL_MERCATOR_SRID, -50.0, tile_xmin, meters_per_pixel,
+                    tile_ymax, SPHERICAL_MERCATOR_SRID, 50.0, meters_per_pixel, 0]
+        self.assertTrue(params[:9] == expected, 'actual({}) != expected({})'.format(params[:9], expected))
+        # envelope expanded by pixel_size
+        expected = (tile_xmin - 100, tile_ymin - 100, tile_xmax + 100, tile_ymax + 100)
+        envelope = GEOSGeometry(memoryview(params[9].ewkb))
+        self.assertTrue(envelope.srid == SPHERICAL_MERCATOR_SRID, envelope.srid)
+        actual = tuple(round(value, 6) for value in envelope.extent)
+        expected = tuple(round(value, 6) for value in expected)
+        self.assertTrue(actual == expected, 'actual({}) != expected({})'.format(actual, expected))
+
+        # time range bounds, a date-only end includes all of that day
+        layers["layer"]["model_time_fieldname"] = "date"
+        time_range = (datetime.date(2014, 11, 1), datetime.date(2014, 11, 30))
+        sql, params, row_fieldnames = tilemgr._get_raw_tile_query("layer", zoom, tilex, tiley, time_range)
+        self.assertTrue(row_fieldnames == ["value", "date"], row_fieldnames)
+        self.assertTrue('t."value", t."date" FROM (SELECT ' in sql, sql)
+        self.assertTrue('"tmstiler_tests_postgismeasurement"."date" >= %s' in sql, sql)
+        self.assertTrue('"tmstiler_tests_postgismeasurement"."date" < %s' in sql, sql)
+        self.assertTrue(sql.count("%s") == len(params), (sql, params))
+        dates = [param for param in params if isinstance(param, datetime.date)]
+        expected = [datetime.datetime(2014, 11, 1), datetime.datetime(2014, 12, 1)]
+        self.assertTrue(dates == expected, 'actual({}) != expected({})'.format(dates, expected))
+
+    def get_temporal_tilemgr(self, dates, time_frame="month"):
+        zoom, tilex, tiley = 10, 911, 626
+        rtm = RasterTileManager()
+        tile_xmin, tile_ymin, tile_xmax, tile_ymax = rtm.tile_sphericalmercator_extent(zoom, tilex, tiley)
+        # each date at a different point, a frame draws only its own points
+        measurements = [DummyMeasurement(GEOSPoint(tile_xmin + 1000 * (index + 1), tile_ymin + 1000 * (index + 1),
+                                                   srid=SPHERICAL_MERCATOR_SRID), date, 1, 1.0)
+                        for index, date in enumerate(dates)]
+        layers = {"layer": {"pixel_size": 100,
+                            "point_position": "upperleft",
+                            "model_queryset": DummyQuerySet(measurements),
+                            "model_point_fieldname": "location",
+                            "model_value_fieldname": "value",
+                            "model_time_fieldname": "date",
+                            "time_frame": time_frame,
+                            "legend_instance": DjangoLegend()}}
+        return DjangoRasterTileLayerManager(layers)
+
+    def test_get_tile_frames(self):
+        zoom, tilex, tiley = 10, 911, 626
+        dates = [datetime.date(2014, 12, 3), datetime.date(2014, 10, 2), datetime.date(2014, 12, 31)]
+        tilemgr = self.get_temporal_tilemgr(dates)
+        time_range = (datetime.date(2014, 9, 15), datetime.date(2014, 12, 31))
+        mimetype, frames = tilemgr.get_tile_frames("layer", zoom, tilex, tiley, time_range)
+        self.assertTrue(mimetype == "image/png", mimetype)
+        actual = [frame_key for frame_key, _ in frames]
+        expected = ["201409", "201410", "201411", "201412"]
+        msg = 'actual({}) != expected({})'.format(actual, expected)
+        self.assertTrue(actual == expected, msg)
+
+        # frames without data are blank
+        frame_images = dict(frames)
+        for frame_key in ("201409", "201411"):
+            self.assertTrue(frame_images[frame_key].getbbox() is None, frame_key)
+            self.assertTrue(frame_images[frame_key].size == (256, 256), frame_key)
+        _, october_image = tilemgr.get_tile("layer", zoom, tilex, tiley, time_range=(datetime.date(2014, 10, 1), datetime.date(2014, 10, 31)))
+        self.assertTrue(frame_images["201410"].tobytes() == october_image.tobytes())
+        _, december_image = tilemgr.get_tile("layer", zoom, tilex, tiley, time_range=(datetime.date(2014, 12, 1), datetime.date(2014, 12, 31)))
+        self.assertTrue(frame_images["201412"].tobytes() == december_image.tobytes())
+        self.assertTrue(december_image.getbbox() is not None)
+
+        # no data, all frames blank
+        tilemgr = self.get_temporal_tilemgr([], time_frame="day")
+        _, frames = tilemgr.get_tile_frames("layer", zoom, tilex, tiley, (datetime.date(2014, 11, 30), datetime.date(2014, 12, 1)), scale=2)
+        self.assertTrue([frame_key for frame_key, _ in frames] == ["20141130", "20141201"], frames)
+        self.assertTrue(all(image.getbbox() is None and image.size == (512, 512) for _, image in frames))
+
+    def test_get_tile_frames_null_times(self):
+        zoom, tilex, tiley = 10, 911, 626
+        tilemgr = self.get_temporal_tilemgr([datetime.date(2014, 11, 3), None, datetime.date(2014, 10, 2)])
+        # without a time range, the frames of all the data are rendered
+        _, frames = tilemgr.get_tile_frames("layer", zoom, tilex, tiley, None)
+        self.assertTrue([frame_key for frame_key, _ in frames] == ["201410", "201411"], frames)
+
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "layer.npz")
+            tile_xmin, tile_ymin, _, _ = tilemgr.tile_sphericalmercator_extent(zoom, tilex, tiley)
+            times = numpy.array(["2014-10-02", "NaT", "2014-11-03"], dtype="datetime64[s]")
+            numpy.savez(path, x=numpy.full(3, tile_xmin + 1000), y=numpy.full(3, tile_ymin + 1000),
+                        value=numpy.ones(3), time=times)
+            layers = {"layer": {"pixel_size": 100,
+                                "point_position": "upperleft",
+                                "layer_source": ColumnarLayerSource(path, time_column="time"),
+                                "legend_instance": DjangoLegend()}}
+            tilemgr = DjangoRasterTileLayerManager(layers)
+            _, frames = tilemgr.get_tile_frames("layer", zoom, tilex, tiley, None)
+            self.assertTrue([frame_key for frame_key, _ in frames] == ["201410", "201411"], frames)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_encode_frames(self):
+        zoom, tilex, tiley = 10, 911, 626
+        tilemgr = self.get_temporal_tilemgr([datetime.date(2014, 10, 2), datetime.date(2014, 12, 3)])
+        time_range = (datetime.date(2014, 9, 1), datetime.date(2014, 12, 31))
+        _, frames = tilemgr.get_tile_frames("layer", zoom, tilex, tiley, time_range)
+        frame_images = [frame_image for _, frame_image in frames]
+        for extension, expected_format in ((".png", "PNG"), (".gif", "GIF")):
+            mimetype, image_bytes = tilemgr.encode_frames(frame_images, extension, duration=250)
+            self.assertTrue(mimetype == "image/{}".format(expected_format.lower()), mimetype)
+            animation = Image.open(io.BytesIO(image_bytes))
+            self.assertTrue(animation.format == expected_format, animation.format)
+            self.assertTrue(animation.n_frames == len(frame_images), (extension, animation.n_frames))
+            self.assertTrue(animation.info.get("duration") == 250, (extension, animation.info))
+            # blank & drawn frames are kept in order
+            actual = []
+            for index in range(animation.n_frames):
+                animation.seek(index)
+                actual.append(animation.convert("RGBA").getchannel("A").getbbox() is not None)
+            expected = [False, True, False, True]
+            msg = '{}: actual({}) != expected({})'.format(extension, actual, expected)
+            self.assertTrue(actual == expected, msg)
+
+        # no frames, a single blank image
+        _, image_bytes = tilemgr.encode_frames([])
+        animation = Image.open(io.BytesIO(image_bytes))
+        self.assertTrue(animation.getbbox() is None)
+
+    def test_get_tile_not_covered(self):
+        zoom, tilex, tiley = 16, 58312, 40100
+        rtm = RasterTileManager()
+        tile_xmin, tile_ymin, tile_xmax, tile_ymax = rtm.tile_sphericalmercator_extent(zoom, tilex, tiley)
+        point = ((tile_xmin + tile_xmax) / 2, (tile_ymin + tile_ymax) / 2)
+        tilemgr = self.get_tilemgr([point], pixel_size=1500)
+        coverage_index = TileCoverageIndex(1500)
+        coverage_index.add_point(*point)
+        tilemgr.layers_config["layer"]["coverage_index"] = coverage_index
+
+        _, tile_image = tilemgr.get_tile("layer", zoom, tilex, tiley)
+        self.assertTrue(tile_image.getbbox() is not None)
+
+        # tiles not covered are returned blank without a query
+        tilemgr.layers_config["layer"]["model_queryset"] = QueryFailingQuerySet([])
+        _, tile_image = tilemgr.get_tile("layer", zoom, tilex + 64, tiley)
+        self.assertTrue(tile_image.getbbox() is None)
+        with self.assertRaises(AssertionError):
+            tilemgr.get_tile("layer", zoom, tilex, tiley)
+
+    def test_invalidate_points_edge_buffer(self):
+        zoom, tilex, tiley = 10, 911, 626
+        rtm = RasterTileManager()
+        tile_xmin, tile_ymin, tile_xmax, tile_ymax = rtm.tile_sphericalmercator_extent(zoom, tilex, tiley)
+        points = [(tile_xmax - 15, (tile_ymin + tile_ymax) / 2),
+                  (tile_xmin + 5, tile_ymax - 5),
+                  (tile_xmax + 10, tile_ymin - 10)]
+        for point_position in DjangoRasterTileLayerManager.VALID_POINT_POSITIONS:
+            for point in points:
+                tilemgr = self.get_tilemgr([point], point_position=point_position, pixel_size=20,
+                                           query_strategy="bboverlaps")
+                dirty_tiles = tilemgr.invalidate_points("layer", [point])
+                # every tile querying the point is dirty
+                for x_offset in (-1, 0, 1):
+                    for y_offset in (-1, 0, 1):
+                        x = tilex + x_offset
+                        y = tiley + y_offset
+                        if list(tilemgr._get_tile_pixels("layer", zoom, x, y)):
+                            msg = '{} {}: {} not in dirty tiles'.format(point_position, point, (zoom, x, y))
+                            self.assertTrue(("layer", zoom, x, y) in dirty_tiles.tiles, msg)
+
+                bbox_dirty_tiles = tilemgr.invalidate_bbox("layer", point[0], point[1], point[0], point[1])
+                self.assertTrue(bbox_dirty_tiles.tiles == dirty_tiles.tiles)
+
+        # the "center" pixel is drawn within 911/626, but the point is within the edge buffer queried for 912/626
+        tilemgr = self.get_tilemgr([points[0]], point_position="center", pixel_size=20)
+        dirty_tiles = tilemgr.invalidate_points("layer", [points[0]])
+        self.assertTrue(("layer", zoom, tilex, tiley) in dirty_tiles.tiles)
+        self.assertTrue(("layer", zoom, tilex + 1, tiley) in dirty_tiles.tiles)
+
+    def test_render_dirty_tiles(self):
+        zoom, tilex, tiley = 10, 911, 626
+        rtm = RasterTileManager()
+        tile_xmin, tile_ymin, tile_xmax, tile_ymax = rtm.tile_sphericalmercator_extent(zoom, tilex, tiley)
+        point = ((tile_xmin + tile_xmax) / 2, (tile_ymin + tile_ymax) / 2)
+        tile_cache = DummyTileCache()
+        tilemgr = self.get_tilemgr([], pixel_size=1500, tile_cache=tile_cache)
+        dirty_key = tilemgr.get_tile_cache_key("layer", zoom, tilex, tiley)
+        clean_key = tilemgr.get_tile_cache_key("layer", zoom, tilex + 8, tiley)
+        tilemgr.get_encoded_tile("layer", zoom, tilex, tiley)
+        tilemgr.get_encoded_tile("layer", zoom, tilex + 8, tiley)
+        blank_tile_bytes = tile_cache.get(dirty_key)
+
+        # add the point, only zooms with tiles at least 'pixel_size' wide (0-14) are marked
+        tilemgr.layers_config["layer"]["model_queryset"].instances.append(
+            DummyMeasurement(GEOSPoint(*point, srid=SPHERICAL_MERCATOR_SRID), None, 1, 1.0))
+        dirty_tiles = tilemgr.invalidate_points("layer", [point])
+        actual = sorted({dirty_zoom for _, dirty_zoom, _, _ in dirty_tiles})
+        self.assertTrue(actual == list(range(15)), actual)
+        self.assertTrue(len(dirty_tiles) < 15 * 4, len(dirty_tiles))
+        self.assertTrue(("layer", zoom, tilex, tiley) in dirty_tiles.tiles)
+
+        # only the dirty tiles in the tile_cache are rendered
+        rendered_count = tilemgr.render_dirty_tiles(dirty_tiles)
+        self.assertTrue(rendered_count == 1, rendered_count)
+        self.assertTrue(len(dirty_tiles) == 0)
+        self.assertTrue(sorted(tile_cache.values) == sorted([dirty_key, clean_key]), sorted(tile_cache.values))
+        self.assertTrue(tile_cache.get(dirty_key) != blank_tile_bytes)
+        self.assertTrue(tile_cache.get(clean_key) == blank_tile_bytes)
+
+        # the layer "invalidation_max_zoom" overrides the default
+        tilemgr.layers_config["layer"]["invalidation_max_zoom"] = 16
+        dirty_tiles = tilemgr.invalidate_bbox("layer", point[0], point[1], point[0], point[1])
+        self.assertTrue(max(dirty_zoom for _, dirty_zoom, _, _ in dirty_tiles) == 16)
+
+    def test_get_composite_tile(self):
+        zoom, tilex, tiley = 10, 911, 626
+        rtm = RasterTileManager()
+        tile_xmin, tile_ymin, tile_xmax, tile_ymax = rtm.tile_sphericalmercator_extent(zoom, tilex, tiley)
+        xm = (tile_xmin + tile_xmax) / 2
+        ym = (tile_ymin + tile_ymax) / 2
+        layers = {}
+        for layername, color_str, points in (("bottom", "rgb(255,0,0)", [(xm, ym), (xm - 5000, ym)]),
+                                             ("top", "rgba(0,0,255,128)", [(xm, ym)])):
+            measurements = [DummyMeasurement(GEOSPoint(x, y, srid=SPHERICAL_MERCATOR_SRID), None, 1, 1.0)
+                            for x, y in points]
+            layers[layername] = {"pixel_size": 1000,
+                                 "point_position": "center",
+                                 "model_queryset": DummyQuerySet(measurements),
+                                 "model_point_fieldname": "location",
+                                 "model_value_fieldname": "value",
+                                 "legend_instance": DjangoLegend(color_str)}
+        tilemgr = DjangoRasterTileLayerManager(layers, composite_workers=2)
+        try:
+            center = (128, 128)
+            bottom_only = (128 - int(5000 / tilemgr._get_meters_per_pixel(zoom, tilex, tiley)), 128)
+
+            _, tile_image = tilemgr.get_composite_tile(["bottom"], zoom, tilex, tiley)
+            # single layers are rendered in the calling thread
+            self.assertTrue(tilemgr._composite_executor is None)
+            self.assertTrue(tile_image.getpixel(center) == (255, 0, 0, 255), tile_image.getpixel(center))
+
+            _, tile_image = tilemgr.get_composite_tile(["bottom", "top"], zoom, tilex, tiley, blend_mode="replace")
+            executor = tilemgr._composite_executor
+            self.assertTrue(executor is not None)
+            # the translucent top layer pixel replaces the bottom layer pixel
+            self.assertTrue(tile_image.getpixel(center) == (0, 0, 255, 128), tile_image.getpixel(center))
+            self.assertTrue(tile_image.getpixel(bottom_only) == (255, 0, 0, 255), tile_image.getpixel(bottom_only))
+
+            # "alpha" (source-over) is the default
+            _, tile_image = tilemgr.get_composite_tile(["bottom", "top"], zoom, tilex, tiley)
+            # the executor is reused
+            self.assertTrue(tilemgr._composite_executor is executor)
+            red, green, blue, alpha = tile_image.getpixel(center)
+            self.assertTrue(120 <= red <= 135 and green == 0 and 120 <= blue <= 135 and alpha == 255,
+                            tile_image.getpixel(center))
+            self.assertTrue(tile_image.getpixel(bottom_only) == (255, 0, 0, 255), tile_image.getpixel(bottom_only))
+
+            with self.assertRaises(ValueError):
+                tilemgr.get_composite_tile([], zoom, tilex, tiley)
+            with self.assertRaises(AssertionError):
+                tilemgr.get_composite_tile(["bottom", "top"], zoom, tilex, tiley, blend_mode="over")
+        finally:
+            tilemgr.close()
+        self.assertTrue(tilemgr._composite_executor is None)
+
+    @unittest.skipUnless(numpy is not None, "numpy not installed")
+    def test_layer_source_matches_model(self):
+        zoom, tilex, tiley = 10, 911, 626
+        rtm = RasterTileManager()
+        tile_xmin, tile_ymin, tile_xmax, tile_ymax = rtm.tile_sphericalmercator_extent(zoom, tilex, tiley)
+        tile_ymid = (tile_ymin + tile_ymax) / 2
+        points = [(tile_xmin + 10, tile_ymid),
+                  (tile_xmin - 80, tile_ymid),
+                  (tile_xmax - 15, tile_ymid),
+                  (tile_xmax + 30, tile_ymid - 5000),
+                  ((tile_xmin + tile_xmax) / 2, tile_ymax + 60),
+                  ((tile_xmin + tile_xmax) / 2 + 1234.5, tile_ymid + 678.9)]
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "layer.npz")
+            xs, ys = zip(*points)
+            numpy.savez(path, x=numpy.array(xs), y=numpy.array(ys), value=numpy.ones(len(points)))
+            source = ColumnarLayerSource(path)
+            for point_position in DjangoRasterTileLayerManager.VALID_POINT_POSITIONS:
+                expected = None
+                for query_strategy in ("within", "bboverlaps"):
+                    tilemgr = self.get_tilemgr(points, point_position=point_position, query_strategy=query_strategy)
+                    actual = sorted(pixel_bbox for pixel_bbox, _ in tilemgr._get_tile_pixels("layer", zoom, tilex, tiley))
+                    self.assertTrue(len(actual) == len(points), actual)
+                    if expected is None:
+                        expected = actual
+                    msg = '{} {}: actual({}) != expected({})'.format(point_position, query_strategy, actual, expected)
+                    self.assertTrue(actual == expected, msg)
+
+                layers = {"layer": {"pixel_size": 100,
+                                    "point_position": point_position,
+                                    "layer_source": source,
+                                    "legend_instance": DjangoLegend()}}
+                tilemgr = DjangoRasterTileLayerManager(layers)
+                actual = sorted(pixel_bbox for pixel_bbox, _ in tilemgr._get_tile_pixels("layer", zoom, tilex, tiley))
+                msg = '{} layer_source: actual({}) != expected({})'.format(point_position, actual, expected)
+                self.assertTrue(actual == expected, msg)
+        finally:
+            shutil.rmtree(directory)
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file
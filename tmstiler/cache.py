@@ -0,0 +1,503 @@
+#!/usr/bin/env python
+"""
+Tile caches for encoded tile images, usable as the DjangoRasterTileLayerManager 'tile_cache'.
+Caches implement the django cache 'get(key)', 'set(key, value)' and 'delete(key)' methods.
+"""
+import fcntl
+import hashlib
+import os
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing import shared_memory
+
+
+# tmpfs backing POSIX shared memory on linux, defaults to 64MB in docker containers
+SHARED_MEMORY_PATH = "/dev/shm"
+
+class InvalidCacheConfiguration(Exception):
+    pass
+
+
+def _get_umask():
+    # os.umask() can only be read by setting it
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+
+class SharedMemoryTileCache:
+    """
+    Tile cache shared by all local processes, stored in a fixed size shared memory segment.
+
+    The segment is divided into 'slot_count' slots of 'slot_size' bytes.
+    A key is stored in one of the 'bucket_size' consecutive slots starting at (key hash % slot_count),
+    replacing the oldest entry of the bucket when all slots are in use.
+    Values larger than a slot are not cached.
+
+    Reads take no lock, each slot holds a sequence number that is odd while the slot is being written
+    and incremented on every write, a read is only accepted if the sequence number is unchanged after the read.
+    Writes are serialized between processes with an flock() on 'lock_path'.
+
+    The segment is not removed when processes exit, so a restarted process starts with a warm cache.
+    Use unlink() to remove the segment.
+
+    The default layout uses 32MB, a new segment larger than the free space of /dev/shm is refused
+    (writing past the free space of /dev/shm kills the process with SIGBUS).
+    """
+    MAGIC = b"TMSC"
+    HEADER_FORMAT = "<4sII"  # magic, slot_count, slot_size
+    SLOT_HEADER_FORMAT = "<IQHIdd"  # sequence, key hash, key length, value length, written, expires
+    SEQUENCE_FORMAT = "<I"
+    SLOT_FIELDS_FORMAT = "<QHIdd"  # SLOT_HEADER_FORMAT fields following the sequence
+    READ_RETRIES = 3
+
+    def __init__(self, name="tmstiler-tiles", slot_count=1024, slot_size=32768, bucket_size=4, lock_path=None):
+        """
+        :param name: shared memory segment name, processes using the same name share the cache
+        :param slot_count: number of slots
+        :param slot_size: slot size in bytes, (slot_count * slot_size) bytes of shared memory are used
+        :param bucket_size: number of slots a key may be stored in
+        :param lock_path: file used to serialize writes, defaults to '<tempdir>/<name>.lock'
+        """
+        self.header_size = struct.calcsize(self.HEADER_FORMAT)
+        self.slot_header_size = struct.calcsize(self.SLOT_HEADER_FORMAT)
+        if slot_size <= self.slot_header_size:
+            raise InvalidCacheConfiguration("slot_size({}) must be larger than {}".format(slot_size,
+                                                                                         self.slot_header_size))
+        self.name = name
+        self.slot_count = slot_count
+        self.slot_size = slot_size
+        self.bucket_size = min(bucket_size, slot_count)
+        if lock_path is None:
+            lock_path = os.path.join(tempfile.gettempdir(), "{}.lock".format(name))
+        self.lock_path = lock_path
+        self._lock_fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._thread_lock = threading.Lock()
+
+        with self._write_lock():
+            self.shm = self._open_shared_memory(self.header_size + (slot_count * slot_size))
+            magic, existing_slot_count, existing_slot_size = struct.unpack_from(self.HEADER_FORMAT, self.shm.buf, 0)
+            if magic != self.MAGIC:
+                struct.pack_into(self.HEADER_FORMAT, self.shm.buf, 0, self.MAGIC, slot_count, slot_size)
+            elif (existing_slot_count, existing_slot_size) != (slot_count, slot_size):
+                msg = "Existing shared memory '{}' layout (slot_count={}, slot_size={}) != given ({}, {})".format(
+                    name, existing_slot_count, existing_slot_size, slot_count, slot_size)
+                self.shm.close()
+                raise InvalidCacheConfiguration(msg)
+
+    def _open_shared_memory(self, size):
+        kwargs = {}
+        if sys.version_info >= (3, 13):
+            kwargs["track"] = False
+        try:
+            shm = shared_memory.SharedMemory(name=self.name, **kwargs)
+        except FileNotFoundError:
+            self._check_shared_memory_space(size)
+            try:
+                shm = shared_memory.SharedMemory(name=self.name, create=True, size=size, **kwargs)
+            except FileExistsError:
+                # created by a process using another 'lock_path'
+                shm = shared_memory.SharedMemory(name=self.name, **kwargs)
+        if sys.version_info < (3, 13):
+            # prevent the segment from being removed when this process exits
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name, "shared_memory")
+        if shm.size < size:
+            shm.close()
+            raise InvalidCacheConfiguration("Existing shared memory '{}' size({}) < expected({})".format(self.name,
+                                                                                                        shm.size,
+                                                                                                        size))
+        return shm
+
+    def _check_shared_memory_space(self, size):
+        if not os.path.isdir(SHARED_MEMORY_PATH):
+            return
+        stat = os.statvfs(SHARED_MEMORY_PATH)
+        available = stat.f_bavail * stat.f_frsize
+        if size > available:
+            msg = ("Shared memory '{}' size({}) > {} free space({}), "
+                   "reduce slot_count/slot_size or increase {} (ex: docker run --shm-size)").format(
+                self.name, size, SHARED_MEMORY_PATH, available, SHARED_MEMORY_PATH)
+            raise InvalidCacheConfiguration(msg)
+
+    def _write_lock(self):
+        return _FileLock(self._thread_lock, self._lock_fd)
+
+    def _key_hash(self, key_bytes):
+        return int.from_bytes(hashlib.blake2b(key_bytes, digest_size=8).digest(), "little")
+
+    def _bucket_offsets(self, key_hash):
+        first_slot = key_hash % self.slot_count
+        for i in range(self.bucket_size):
+            slot = (first_slot + i) % self.slot_count
+            yield self.header_size + (slot * self.slot_size)
+
+    def _read_slot(self, offset, key_hash, key_bytes):
+        """
+        :return: value bytes, or None if the slot does not hold the key
+        """
+        buf = self.shm.buf
+        for _ in range(self.READ_RETRIES):
+            sequence, slot_key_hash, key_length, value_length, _, expires = struct.unpack_from(self.SLOT_HEADER_FORMAT,
+                                                                                                buf,
+                                                                                                offset)
+            if sequence % 2:
+                # slot being written
+                continue
+            if slot_key_hash != key_hash or value_length == 0:
+                return None
+            data_offset = offset + self.slot_header_size
+            slot_key_bytes = bytes(buf[data_offset:data_offset + key_length])
+            value_offset = data_offset + key_length
+            value = bytes(buf[value_offset:value_offset + value_length])
+            if struct.unpack_from(self.SEQUENCE_FORMAT, buf, offset)[0] != sequence:
+                # slot changed during read
+                continue
+            if slot_key_bytes != key_bytes:
+                return None
+            if expires and expires < time.time():
+                return None
+            return value
+        return None
+
+    def _slot_holds_key(self, offset, key_hash, key_bytes):
+        """
+        Check the slot key while holding the write lock,
+        the sequence is ignored as a slot may be left odd by a writer killed during a write.
+        """
+        _, slot_key_hash, key_length, value_length, _, _ = struct.unpack_from(self.SLOT_HEADER_FORMAT,
+                                                                              self.shm.buf,
+                                                                              offset)
+        data_offset = offset + self.slot_header_size
+        return bool(value_length) and slot_key_hash == key_hash and \
+            bytes(self.shm.buf[data_offset:data_offset + key_length]) == key_bytes
+
+    def _write_slot(self, offset, key_hash, key_bytes, value, expires):
+        buf = self.shm.buf
+        # odd sequence marks the slot as being written,
+        # set from the current value (not incremented) so that a slot left odd by a killed writer becomes even on commit
+        sequence = struct.unpack_from(self.SEQUENCE_FORMAT, buf, offset)[0] | 1
+        struct.pack_into(self.SEQUENCE_FORMAT, buf, offset, sequence)
+        data_offset = offset + self.slot_header_size
+        buf[data_offset:data_offset + len(key_bytes)] = key_bytes
+        value_offset = data_offset + len(key_bytes)
+        buf[value_offset:value_offset + len(value)] = value
+        struct.pack_into(self.SLOT_FIELDS_FORMAT, buf, offset + struct.calcsize(self.SEQUENCE_FORMAT),
+                         key_hash, len(key_bytes), len(value), time.time(), expires)
+        struct.pack_into(self.SEQUENCE_FORMAT, buf, offset, (sequence + 1) & 0xffffffff)
+
+    def get(self, key, default=None):
+        key_bytes = key.encode("utf8")
+        key_hash = self._key_hash(key_bytes)
+        for offset in self._bucket_offsets(key_hash):
+            value = self._read_slot(offset, key_hash, key_bytes)
+            if value is not None:
+                return value
+        return default
+
+    def set(self, key, value, timeout=None):
+        """
+        :param key: tile cache key
+        :param value: encoded tile bytes
+        :param timeout: seconds until the value expires, None for no expiry
+        :return: (bool) True if the value was cached, values larger than the slot_size are not cached
+        """
+        key_bytes = key.encode("utf8")
+        if self.slot_header_size + len(key_bytes) + len(value) > self.slot_size:
+            return False
+        key_hash = self._key_hash(key_bytes)
+        expires = time.time() + timeout if timeout is not None else 0.0
+        with self._write_lock():
+            target_offset = None
+            oldest_written = None
+            for offset in self._bucket_offsets(key_hash):
+                if self._slot_holds_key(offset, key_hash, key_bytes):
+                    target_offset = offset
+                    break
+                _, _, _, value_length, written, _ = struct.unpack_from(self.SLOT_HEADER_FORMAT, self.shm.buf, offset)
+                if not value_length:
+                    written = 0.0
+                if oldest_written is None or written < oldest_written:
+                    target_offset = offset
+                    oldest_written = written
+            self._write_slot(target_offset, key_hash, key_bytes, value, expires)
+        return True
+
+    def delete(self, key):
+        key_bytes = key.encode("utf8")
+        key_hash = self._key_hash(key_bytes)
+        with self._write_lock():
+            for offset in self._bucket_offsets(key_hash):
+                if self._slot_holds_key(offset, key_hash, key_bytes):
+                    self._write_slot(offset, 0, b"", b"", 0.0)
+
+    def clear(self):
+        with self._write_lock():
+            for slot in range(self.slot_count):
+                self._write_slot(self.header_size + (slot * self.slot_size), 0, b"", b"", 0.0)
+
+    def close(self):
+        self.shm.close()
+        os.close(self._lock_fd)
+
+    def unlink(self):
+        """
+        Remove the shared memory segment, existing attached processes keep their mapping until closed.
+        """
+        if sys.version_info < (3, 13):
+            # re-register, as unlink() unregisters the segment from the resource_tracker
+            from multiprocessing import resource_tracker
+            resource_tracker.register(self.shm._name, "shared_memory")
+        self.shm.unlink()
+
+
+class DiskTileCache:
+    """
+    Size bounded tile cache stored in a '<root>/<layername>/<zoom>/<tilex>/<tiley>.png' directory layout.
+
+    Tiles are written to a temporary file and renamed into place,
+    so concurrent readers and writers (threads or processes) never see partially written tiles.
+    Tile sizes and access times are kept in a sqlite index, '<root>/index.sqlite3'.
+    Access times are recorded in memory and written to the index every 'access_flush_count' reads.
+    When the total size exceeds 'max_size', expired and then least recently accessed tiles are removed
+    until the total size is below (max_size * EVICTION_RATIO).
+    """
+    INDEX_FILENAME = "index.sqlite3"
+    EVICTION_RATIO = 0.9
+
+    def __init__(self, root, max_size=1024 ** 3, timeout=None, access_flush_count=256):
+        """
+        :param root: cache root directory
+        :param max_size: maximum total size of cached tiles in bytes
+        :param timeout: seconds after which cached tiles expire, None for no expiry
+        :param access_flush_count: number of reads after which recorded access times are written to the index
+        """
+        self.root = os.path.abspath(root)
+        self.max_size = max_size
+        self.timeout = timeout
+        self.access_flush_count = access_flush_count
+        # mkstemp() creates files readable by the owner only,
+        # tiles are given the default file mode so that they can be served by a front-end web server (X-Sendfile)
+        self.file_mode = 0o666 & ~_get_umask()
+        os.makedirs(self.root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._accessed = {}
+        self._connection = sqlite3.connect(os.path.join(self.root, self.INDEX_FILENAME),
+                                           timeout=30,
+                                           isolation_level=None,
+                                           check_same_thread=False)
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS tiles "
+                                     "(key TEXT PRIMARY KEY, size INTEGER, written REAL, accessed REAL)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS tiles_accessed ON tiles (accessed)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS total (id INTEGER PRIMARY KEY, size INTEGER)")
+            self._connection.execute("INSERT OR IGNORE INTO total (id, size) VALUES (1, 0)")
+
+    def _key_path(self, key):
+        key_parts = key.split("/")
+        if any(part in ("", ".", "..") for part in key_parts):
+            raise ValueError("Invalid tile cache key: {}".format(key))
+        return os.path.join(self.root, *key_parts)
+
+    def get_path(self, key):
+        """
+        Get the file path of the cached tile, for serving the file directly (ex: django FileResponse)
+        :param key: tile cache key
+        :return: cached tile file path, or None if not cached
+        """
+        path = self._key_path(key)
+        try:
+            modified = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return None
+        now = time.time()
+        if self.timeout is not None and modified + self.timeout < now:
+            self.delete(key)
+            return None
+        with self._lock:
+            self._accessed[key] = now
+            if len(self._accessed) >= self.access_flush_count:
+                self._flush_accessed()
+        return path
+
+    def get(self, key, default=None):
+        path = self.get_path(key)
+        if path is None:
+            return default
+        try:
+            with open(path, "rb") as tile_file:
+                return tile_file.read()
+        except FileNotFoundError:
+            # removed by another process
+            return default
+
+    def set(self, key, value):
+        path = self._key_path(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+        try:
+            os.fchmod(fd, self.file_mode)
+            with os.fdopen(fd, "wb") as temp_file:
+                temp_file.write(value)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        now = time.time()
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._connection.execute("SELECT size FROM tiles WHERE key = ?", (key, )).fetchone()
+                previous_size = row[0] if row else 0
+                self._connection.execute("INSERT OR REPLACE INTO tiles (key, size, written, accessed) "
+                                         "VALUES (?, ?, ?, ?)", (key, len(value), now, now))
+                self._connection.execute("UPDATE total SET size = size + ? WHERE id = 1",
+                                         (len(value) - previous_size, ))
+                total_size = self._connection.execute("SELECT size FROM total WHERE id = 1").fetchone()[0]
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            if total_size > self.max_size:
+                self._evict()
+
+    def delete(self, key):
+        with self._lock:
+            self._delete_keys([key])
+
+    def clear(self):
+        with self._lock:
+            keys = [key for key, in self._connection.execute("SELECT key FROM tiles")]
+            self._delete_keys(keys)
+
+    def warm(self, cache, limit=None):
+        """
+        Load the most recently accessed tiles into the given cache (ex: a SharedMemoryTileCache)
+        :param cache: cache object with a 'set(key, value)' method
+        :param limit: maximum number of tiles to load
+        :return: number of tiles loaded
+        """
+        with self._lock:
+            self._flush_accessed()
+            sql = "SELECT key FROM tiles ORDER BY accessed DESC"
+            if limit is not None:
+                sql += " LIMIT {}".format(int(limit))
+            keys = [key for key, in self._connection.execute(sql)]
+        loaded_count = 0
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                cache.set(key, value)
+                loaded_count += 1
+        return loaded_count
+
+    def _flush_accessed(self):
+        accessed = [(accessed, key) for key, accessed in self._accessed.items()]
+        self._accessed.clear()
+        if accessed:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._connection.executemany("UPDATE tiles SET accessed = ? WHERE key = ?", accessed)
+                self._connection.execute("COMMIT")
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+
+    def _delete_keys(self, keys):
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            for key in keys:
+                row = self._connection.execute("SELECT size FROM tiles WHERE key = ?", (key, )).fetchone()
+                if not row:
+                    continue
+                self._connection.execute("DELETE FROM tiles WHERE key = ?", (key, ))
+                self._connection.execute("UPDATE total SET size = size - ? WHERE id = 1", (row[0], ))
+                try:
+                    os.remove(self._key_path(key))
+                except FileNotFoundError:
+                    pass
+            self._connection.execute("COMMIT")
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+
+    def _evict(self):
+        self._flush_accessed()
+        if self.timeout is not None:
+            expired_rows = self._connection.execute("SELECT key FROM tiles WHERE written < ?",
+                                                    (time.time() - self.timeout, )).fetchall()
+            expired_keys = [key for key, in expired_rows]
+            self._delete_keys(expired_keys)
+        total_size = self._connection.execute("SELECT size FROM total WHERE id = 1").fetchone()[0]
+        target_size = self.max_size * self.EVICTION_RATIO
+        evicted_keys = []
+        for key, size in self._connection.execute("SELECT key, size FROM tiles ORDER BY accessed").fetchall():
+            if total_size <= target_size:
+                break
+            evicted_keys.append(key)
+            total_size -= size
+        self._delete_keys(evicted_keys)
+
+    def close(self):
+        with self._lock:
+            self._flush_accessed()
+            self._connection.close()
+
+
+class TieredTileCache:
+    """
+    Tile cache combining multiple caches, ex: TieredTileCache(SharedMemoryTileCache(), DiskTileCache("/var/cache/tiles"))
+    Values are read from the first cache containing the key, and copied to the caches before it.
+    Values are written to all caches.
+    """
+
+    def __init__(self, *caches):
+        self.caches = caches
+
+    def get(self, key, default=None):
+        for index, cache in enumerate(self.caches):
+            value = cache.get(key)
+            if value is not None:
+                for upper_cache in self.caches[:index]:
+                    upper_cache.set(key, value)
+                return value
+        return default
+
+    def set(self, key, value):
+        for cache in self.caches:
+            cache.set(key, value)
+
+    def delete(self, key):
+        for cache in self.caches:
+            cache.delete(key)
+
+
+class _FileLock:
+    """
+    Exclusive lock between threads (threading.Lock) and processes (flock).
+    """
+
+    def __init__(self, thread_lock, fd):
+        self.thread_lock = thread_lock
+        self.fd = fd
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        except BaseException:
+            self.thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.thread_lock.release()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+"""
+ColumnarLayerSource for reading layer points directly from local columnar files (Parquet, Arrow IPC or NumPy .npz),
+allowing read-only layers to be rendered without loading the layer data into a database.
+
+Requires numpy, and pyarrow for Parquet & Arrow IPC files.
+Layers are rendered by tmstiler.django.DjangoRasterTileLayerManager ("layer_source" layer config),
+so django with django.contrib.gis (and the GEOS/GDAL libraries) is also needed to render tiles.
+"""
+import os
+import threading
+
+from .rtm import get_time_range_bounds
+
+
+PARQUET_EXTENSIONS = (".parquet", ".pq")
+ARROW_IPC_EXTENSIONS = (".arrow", ".feather", ".ipc")
+NPZ_EXTENSIONS = (".npz", )
+DEFAULT_NPZ_CHUNK_ROWS = 65536
+
+
+class UnsupportedFileFormat(Exception):
+    pass
+
+
+class ColumnMissing(Exception):
+    pass
+
+
+def _array_bounds(xs, ys):
+    if not len(xs):
+        return None
+    return float(xs.min()), float(ys.min()), float(xs.max()), float(ys.max())
+
+
+class ColumnarLayerSource:
+    """
+    Layer points read from a columnar file with x, y (Spherical Mercator meters) and value (and optional time) columns.
+
+    The file is divided into chunks (Parquet row groups, Arrow IPC record batches or 'npz_chunk_rows' rows of .npz arrays),
+    and the bounding box of each chunk is kept so that only the chunks intersecting a tile are read.
+    Files should be sorted by a spatial key (ex: tile x/y at the layer's typical zoom) so that each chunk covers a small area.
+
+    Parquet files are memory mapped and only the x/y/value(/time) columns of intersecting row groups are decoded.
+    Arrow IPC files are memory mapped, and record batch columns are used without copying.
+    .npz arrays are loaded once, and chunks are views of the loaded arrays.
+    """
+
+    def __init__(self, path, x_column="x", y_column="y", value_column="value", time_column=None,
+                 npz_chunk_rows=DEFAULT_NPZ_CHUNK_ROWS):
+        """
+        :param path: Parquet (.parquet), Arrow IPC (.arrow, .feather, .ipc) or NumPy (.npz) file path
+        :param x_column: point x (Spherical Mercator meters) column name
+        :param y_column: point y (Spherical Mercator meters) column name
+        :param value_column: point value column name
+        :param time_column: optional date/datetime column name, defining a temporal layer
+        :param npz_chunk_rows: number of rows in each .npz chunk
+        """
+        self.path = path
+        self.x_column = x_column
+        self.y_column = y_column
+        self.value_column = value_column
+        self.time_column = time_column
+        self.columns = [x_column, y_column, value_column]
+        if time_column:
+            self.columns.append(time_column)
+        self._lock = threading.Lock()
+
+        extension = os.path.splitext(path)[1].lower()
+        if extension in PARQUET_EXTENSIONS:
+            self.format = "parquet"
+            self._open_parquet()
+        elif extension in ARROW_IPC_EXTENSIONS:
+            self.format = "arrow"
+            self._open_arrow()
+        elif extension in NPZ_EXTENSIONS:
+            self.format = "npz"
+            self._open_npz(npz_chunk_rows)
+        else:
+            raise UnsupportedFileFormat("Unsupported layer source file extension: {}".format(extension))
+
+    def _check_columns(self, available_columns):
+        missing_columns = [column for column in self.columns if column not in available_columns]
+        if missing_columns:
+            raise ColumnMissing("{} does not contain columns: {}".format(self.path, missing_columns))
+
+    def _open_parquet(self):
+        import pyarrow.parquet as pq
+
+        self._parquet_file = pq.ParquetFile(self.path, memory_map=True)
+        schema = self._parquet_file.schema_arrow
+        self._check_columns(schema.names)
+        metadata = self._parquet_file.metadata
+        x_index = schema.get_field_index(self.x_column)
+        y_index = schema.get_field_index(self.y_column)
+        self.chunk_count = metadata.num_row_groups
+        self.chunk_bounds = []
+        for index in range(self.chunk_count):
+            row_group = metadata.row_group(index)
+            if not row_group.num_rows:
+                self.chunk_bounds.append(None)
+                continue
+            x_statistics = row_group.column(x_index).statistics
+            y_statistics = row_group.column(y_index).statistics
+            if x_statistics is not None and x_statistics.has_min_max and \
+                    y_statistics is not None and y_statistics.has_min_max:
+                self.chunk_bounds.append((x_statistics.min, y_statistics.min, x_statistics.max, y_statistics.max))
+            else:
+                # row group written without statistics
+                xs, ys = self._read_chunk(index, (self.x_column, self.y_column))
+                self.chunk_bounds.append(_array_bounds(xs, ys))
+
+    def _open_arrow(self):
+        import pyarrow as pa
+
+        reader = pa.ipc.open_file(pa.memory_map(self.path, "r"))
+        self._check_columns(reader.schema.names)
+        self._column_indexes = {column: reader.schema.get_field_index(column) for column in self.columns}
+        # batches reference the memory mapped file, no data is read here
+        self._batches = [reader.get_batch(index) for index in range(reader.num_record_batches)]
+        self.chunk_count = len(self._batches)
+        self.chunk_bounds = [_array_bounds(*self._read_chunk(index, (self.x_column, self.y_column)))
+                             for index in range(self.chunk_count)]
+
+    def _open_npz(self, npz_chunk_rows):
+        import numpy as np
+
+        with np.load(self.path) as npz_file:
+            self._check_columns(npz_file.files)
+            self._arrays = {column: npz_file[column] for column in self.columns}
+        self._npz_chunk_rows = npz_chunk_rows
+        row_count = len(self._arrays[self.x_column])
+        self.chunk_count = (row_count + npz_chunk_rows - 1) // npz_chunk_rows
+        self.chunk_bounds = [_array_bounds(*self._read_chunk(index, (self.x_column, self.y_column)))
+                             for index in range(self.chunk_count)]
+
+    def _read_chunk(self, index, columns):
+        """
+        :param index: chunk index
+        :param columns: column names to read
+        :return: [<numpy array>, ...] in the order of the given columns
+        """
+        if self.format == "parquet":
+            # ParquetFile reads are not thread-safe
+            with self._lock:
+                table = self._parquet_file.read_row_group(index, columns=list(columns), use_threads=False)
+            return [table.column(column).to_numpy() for column in columns]
+        elif self.format == "arrow":
+            batch = self._batches[index]
+            return [batch.column(self._column_indexes[column]).to_numpy(zero_copy_only=False) for column in columns]
+        chunk_slice = slice(index * self._npz_chunk_rows, (index + 1) * self._npz_chunk_rows)
+        return [self._arrays[column][chunk_slice] for column in columns]
+
+    def intersecting_chunks(self, minx, miny, maxx, maxy):
+        """
+        :param minx: extent minimum X in Spherical Mercator (meters)
+        :param miny: extent minimum Y in Spherical Mercator (meters)
+        :param maxx: extent maximum X in Spherical Mercator (meters)
+        :param maxy: extent maximum Y in Spherical Mercator (meters)
+        :return: (list) indexes of the chunks whose bounding box intersects the extent
+        """
+        indexes = []
+        for index, bounds in enumerate(self.chunk_bounds):
+            if bounds is None:
+                continue
+            chunk_minx, chunk_miny, chunk_maxx, chunk_maxy = bounds
+            if chunk_minx <= maxx and minx <= chunk_maxx and chunk_miny <= maxy and miny <= chunk_maxy:
+                indexes.append(index)
+        return indexes
+
+    def query(self, minx, miny, maxx, maxy, time_range=None):
+        """
+        Read the points within the given extent, only the intersecting chunks are read.
+        :param minx: extent minimum X in Spherical Mercator (meters)
+        :param miny: extent minimum Y in Spherical Mercator (meters)
+        :param maxx: extent maximum X in Spherical Mercator (meters)
+        :param maxy: extent maximum Y in Spherical Mercator (meters)
+        :param time_range: (start, end) inclusive range of the 'time_column', ignored if 'time_column' is not defined.
+            A date-only end includes all of that day.
+            When 'time_column' is defined, rows with a null (NaT) time are excluded.
+        :return: generator of (xs, ys, values, times) numpy arrays for each intersecting chunk,
+            times is None if 'time_column' is not defined
+        """
+        import numpy as np
+
+        if time_range is not None and self.time_column:
+            start, end, end_inclusive = get_time_range_bounds(time_range)
+            start = np.datetime64(start)
+            end = np.datetime64(end)
+        for index in self.intersecting_chunks(minx, miny, maxx, maxy):
+            xs, ys, values, *times = self._read_chunk(index, self.columns)
+            times = times[0] if times else None
+            mask = (xs >= minx) & (xs <= maxx) & (ys >= miny) & (ys <= maxy)
+            if times is not None:
+                mask &= ~np.isnat(times)
+                if time_range is not None:
+                    mask &= (times >= start) & ((times <= end) if end_inclusive else (times < end))
+            if not mask.any():
+                continue
+            if mask.all():
+                yield xs, ys, values, times
+            else:
+                yield xs[mask], ys[mask], values[mask], times[mask] if times is not None else None
+
+    def iter_points(self):
+        """
+        :return: generator of (xm, ym) Spherical Mercator (meters) coordinates of all points
+        """
+        for index in range(self.chunk_count):
+            xs, ys = self._read_chunk(index, (self.x_column, self.y_column))
+            yield from zip(xs.tolist(), ys.tolist())
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+TileCoverageIndex for recording which tiles of a layer contain data.
+Allows tile requests for empty tiles to be answered without querying the layer data.
+"""
+import json
+
+from .rtm import RasterTileManager
+
+
+class TileCoverageIndex:
+    """
+    Sparse per-zoom set of the tiles containing layer data.
+
+    Each indexed point marks every tile within 'pixel_size' meters of the point,
+    matching the 1 pixel(bin_size) edge buffer applied to the tile query in get_tile().
+    Tiles are stored as a single integer, (tilex * tiles_at_zoom) + tiley, per zoom.
+
+    By default zoom levels are indexed down to the deepest zoom at which a tile is at least 'pixel_size' wide,
+    beyond it a point marks as many tiles as the zoom level's (2**zoom) growth.
+    Tiles at deeper zoom levels are checked against their ancestor tile at the deepest indexed zoom.
+
+    NOTE: Points can only be added, the index is expected to be rebuilt if data is removed.
+    Indexed points are never hidden: at zoom levels not indexed, covers() checks the ancestor tile at an indexed zoom,
+    or returns True above the shallowest indexed zoom, and so an index holding removed points only renders blank tiles.
+    Points added to the layer data but not to the index (see invalidate_points()/invalidate_bbox()) are hidden.
+    """
+
+    def __init__(self, pixel_size, zooms=None):
+        """
+        :param pixel_size: pixel area size in meters, as defined in the layer's config
+        :param zooms: zoom levels to index,
+            if not given zoom 0 to the deepest zoom with tiles at least 'pixel_size' wide are indexed
+        """
+        self.pixel_size = pixel_size
+        self.rtm = RasterTileManager()
+        if zooms is None:
+            zooms = range(0, self.rtm.get_deepest_zoom(pixel_size) + 1)
+        self.tiles = {zoom: set() for zoom in zooms}
+
+    def add_point(self, xm, ym):
+        """
+        Mark the tiles covered by the given point at all indexed zoom levels
+        :param xm: X in Spherical Mercator (meters)
+        :param ym: Y in Spherical Mercator (meters)
+        """
+        self.add_extent(xm, ym, xm, ym)
+
+    def add_extent(self, minx, miny, maxx, maxy):
+        """
+        Mark the tiles covered by any point within the given extent at all indexed zoom levels
+        :param minx: extent minimum X in Spherical Mercator (meters)
+        :param miny: extent minimum Y in Spherical Mercator (meters)
+        :param maxx: extent maximum X in Spherical Mercator (meters)
+        :param maxy: extent maximum Y in Spherical Mercator (meters)
+        """
+        minx -= self.pixel_size
+        miny -= self.pixel_size
+        maxx += self.pixel_size
+        maxy += self.pixel_size
+        for zoom, zoom_tiles in self.tiles.items():
+            tiles_at_zoom, _ = self.rtm.tiles_per_dimension(zoom)
+            for tilex, tiley in self.rtm.sphericalmercator_extent_to_tiles(zoom, minx, miny, maxx, maxy):
+                zoom_tiles.add(tilex * tiles_at_zoom + tiley)
+
+    def add_points(self, points):
+        """
+        :param points: iterable of (xm, ym) Spherical Mercator (meters) coordinates
+        """
+        for xm, ym in points:
+            self.add_point(xm, ym)
+
+    def covers(self, zoom, tilex, tiley):
+        """
+        :param zoom: zoom level
+        :param tilex: TMS tile X
+        :param tiley: TMS tile Y
+        :return: (bool) True if the tile may contain data.
+            Tiles of zoom levels not indexed are checked against their ancestor tile at the deepest indexed zoom
+            above them, and are always True when above all indexed zoom levels.
+        """
+        indexed_zooms = [indexed_zoom for indexed_zoom in self.tiles if indexed_zoom <= zoom]
+        if not indexed_zooms:
+            return True
+        indexed_zoom = max(indexed_zooms)
+        # the ancestor tile contains the tile, and so any point within 'pixel_size' of it
+        ancestor_tilex = tilex >> (zoom - indexed_zoom)
+        ancestor_tiley = tiley >> (zoom - indexed_zoom)
+        tiles_at_zoom, _ = self.rtm.tiles_per_dimension(indexed_zoom)
+        return (ancestor_tilex * tiles_at_zoom + ancestor_tiley) in self.tiles[indexed_zoom]
+
+    def tile_count(self, zoom):
+        """
+        :param zoom: zoom level
+        :return: number of tiles containing data at the given zoom
+        """
+        return len(self.tiles[zoom])
+
+    def dump(self, fileobj):
+        """
+        Serialize the index as JSON to the given (text) file object
+        :param fileobj: writable file object
+        """
+        data = {"pixel_size": self.pixel_size,
+                "tiles": {str(zoom): sorted(zoom_tiles) for zoom, zoom_tiles in self.tiles.items()}}
+        json.dump(data, fileobj)
+
+    @classmethod
+    def load(cls, fileobj):
+        """
+        Load an index previously serialized with dump()
+        :param fileobj: readable (text) file object
+        :return: TileCoverageIndex instance
+        """
+        data = json.load(fileobj)
+        zooms = [int(zoom) for zoom in data["tiles"]]
+        index = cls(data["pixel_size"], zooms=zooms)
+        for zoom, zoom_tiles in data["tiles"].items():
+            index.tiles[int(zoom)].update(zoom_tiles)
+        return index
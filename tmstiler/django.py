@@ -4,11 +4,19 @@ DjangoRasterTileLayerManager for django specific raster implementations.
 Excepts that for each layer, a django model with a defined Point() field is given.
 """
 import mimetypes
+import threading
+from math import floor
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from types import SimpleNamespace
 
 from django.contrib.gis.geos import Polygon, Point
+from django.db import close_old_connections, connections
 from PIL import Image, ImageDraw
 
-from .rtm import RasterTileManager
+from .rtm import RasterTileManager, get_time_range_bounds, get_time_frames
+from .coverage import TileCoverageIndex
+from .invalidation import DirtyTileSet
 
 
 SPHERICAL_MERCATOR_SRID = 3857  # google maps projection
@@ -26,6 +34,10 @@ class ObjectMissingExpectedMethod(Exception):
     pass
 
 
+class LayerNotTemporal(Exception):
+    pass
+
+
 class ReferenceLegend:
 
     def get_color_str(self, model_instance, **kwargs):
@@ -45,17 +57,38 @@ class DjangoRasterTileLayerManager(RasterTileManager):
                              "lowerright",
                              "center")
     VALID_WMS_TYPES = ("TMS", )
+    VALID_QUERY_STRATEGIES = ("within",
+                              "bboverlaps",
+                              "raw")
+    VALID_BLEND_MODES = ("alpha",
+                         "replace")
+    TIME_FRAME_FORMATS = {"year": "%Y",
+                          "month": "%Y%m",
+                          "day": "%Y%m%d",
+                          "hour": "%Y%m%d%H"}
     LAYER_CONFIG_REQUIRED_KEYS = ("pixel_size",
                                   "point_position",
                                   "model_queryset",
                                   "model_point_fieldname",
                                   "model_value_fieldname",
                                   "legend_instance")
+    SOURCE_LAYER_CONFIG_REQUIRED_KEYS = ("pixel_size",
+                                         "point_position",
+                                         "layer_source",
+                                         "legend_instance")
     LAYER_CONFIG_DEFAULTS = {"model_value_fieldname": "value",
                              "round_pixels": False,
-                             "wms_type": "TMS"}
+                             "wms_type": "TMS",
+                             "coverage_index": None,
+                             "query_strategy": "within",
+                             "model_only_fields": None,
+                             "model_time_fieldname": None,
+                             "time_frame": "month",
+                             "layer_source": None,
+                             "invalidation_max_zoom": None}
 
-    def __init__(self, layers_config):
+    def __init__(self, layers_config, tile_pixels_width=256, tile_pixels_height=256, tile_cache=None,
+                 composite_workers=4):
         """
         :param layers_config:
             { <layer name>: {
@@ -66,15 +99,39 @@ class DjangoRasterTileLayerManager(RasterTileManager):
                 "model_value_fieldname": <value fieldname>,
                 "round_pixels": False,
                 "legend_instance": <legend object instance with 'get_color_str()' method, for pixel color calculation>,
+                "coverage_index": <optional TileCoverageIndex, tiles not covered are returned blank without a query>,
+                "query_strategy": "within",  # one of VALID_QUERY_STRATEGIES
+                    # "within": exact test of points within the 1 pixel buffered tile (default)
+                    # "bboverlaps": bounding box overlap test against the 1 pixel expanded tile envelope (index only)
+                    # "raw": pixel x/y & value calculated in the database (PostGIS only)
+                "model_only_fields": <optional field names given to queryset.only() to limit retrieved columns, point/value/time fields are always added>,
+                "model_time_fieldname": <optional date/datetime fieldname, defining a temporal layer>,
+                "time_frame": "month",  # temporal layer animation frame size, one of TIME_FRAME_FORMATS
+                "layer_source": <optional tmstiler.columnar.ColumnarLayerSource, used in place of the "model_*" values>,
+                "invalidation_max_zoom": <optional deepest zoom marked dirty by invalidate_points()/invalidate_bbox(),
+                    default is the deepest zoom with tiles at least 'pixel_size' wide>,
                  },
            }
+        :param tile_pixels_width: tile image width in pixels at scale 1 (ex: 256, 512)
+        :param tile_pixels_height: tile image height in pixels at scale 1
+        :param tile_cache: optional cache object for encoded tiles, supporting the django cache
+            'get(key)' and 'set(key, value)' methods (ex: django.core.cache.caches["tiles"])
+        :param composite_workers: maximum number of threads querying get_composite_tile() layers concurrently
         """
         # check incoming layer config values
         for layer_name, config_values in layers_config.items():
-            if not all(required_config in config_values for required_config in self.LAYER_CONFIG_REQUIRED_KEYS):
-                msg = "Given layer config missing required values! Expected values: {}".format(self.LAYER_CONFIG_REQUIRED_KEYS)
+            required_keys = self.LAYER_CONFIG_REQUIRED_KEYS
+            if config_values.get("layer_source") is not None:
+                required_keys = self.SOURCE_LAYER_CONFIG_REQUIRED_KEYS
+                # legend rows are given the source's column names
+                config_values.setdefault("model_value_fieldname", config_values["layer_source"].value_column)
+                config_values.setdefault("model_time_fieldname", config_values["layer_source"].time_column)
+            if not all(required_config in config_values for required_config in required_keys):
+                msg = "Given layer config missing required values! Expected values: {}".format(required_keys)
                 raise RequiredConfigMissing(msg)
             assert config_values["point_position"] in self.VALID_POINT_POSITIONS
+            assert config_values.get("query_strategy", "within") in self.VALID_QUERY_STRATEGIES
+            assert config_values.get("time_frame", "month") in self.TIME_FRAME_FORMATS
             if not all(callable(getattr(config_values["legend_instance"], m)) for m in self.LEGEND_REQUIRED_METHODS):
                 msg = "given 'legend_instance' object does not have a defined '{}' method!".format(self.LEGEND_REQUIRED_METHODS)
                 raise ObjectMissingExpectedMethod(msg)
@@ -84,73 +141,176 @@ class DjangoRasterTileLayerManager(RasterTileManager):
                 if config_fieldname not in config_values:
                     config_values[config_fieldname] = config_default
         self.layers_config = layers_config
+        self.tile_cache = tile_cache
+        # optional tmstiler.prefetch.TilePrefetcher, queuing tiles near the tiles served by get_encoded_tile()
+        self.prefetcher = None
+        # optional tmstiler.profiling.TileProfiler, capturing the profile of slow (or sampled) get_tile() renders
+        self.profiler = None
+        self.composite_workers = composite_workers
+        # created on first use, worker threads (and their database connections) are reused across requests
+        self._composite_executor = None
+        self._composite_executor_lock = threading.Lock()
 
         # initialize base-class variables
-        super().__init__()
+        super().__init__(tile_pixels_width=tile_pixels_width, tile_pixels_height=tile_pixels_height)
 
-    def _adjust_point_to_upperleft(self, layername, point_object):
+    def _get_upperleft_offset(self, layername):
         """
-        Adjust point so that it represents the upper-left coord for defined pixel size
+        Offset that adjusts a layer point so that it represents the upper-left coord for defined pixel size
         :param layername: Defined in layers_config on initial instantiation.
             needed to retrieve 'point_position' and 'pixel_size' for layer
-        :param point_object: Django Point Object to be adjusted
-        :return: Adjusted Point Object
+        :return: x_offset, y_offset (meters)
         """
         layer_config = self.layers_config[layername]
         point_position = layer_config["point_position"]
         pixel_size = layer_config["pixel_size"]
-        x, y = point_object
+        x_offset = 0.0
+        y_offset = 0.0
         if point_position == "upperright":
-            x -= pixel_size
+            x_offset -= pixel_size
         elif point_position == "lowerright":
-            x -= pixel_size
-            y -= pixel_size
+            x_offset -= pixel_size
+            y_offset += pixel_size
         elif point_position == "lowerleft":
-            y -= pixel_size
+            y_offset += pixel_size
         elif point_position == "center":
-            x -= point_position/2.0
-            y -= pixel_size/2.0
+            x_offset -= pixel_size/2.0
+            y_offset += pixel_size/2.0
+        return x_offset, y_offset
 
-        return Point(x, y, srid=point_object.srid)
+    def _adjust_point_to_upperleft(self, layername, point_object):
+        """
+        Adjust point so that it represents the upper-left coord for defined pixel size
+        :param layername: Defined in layers_config on initial instantiation.
+            needed to retrieve 'point_position' and 'pixel_size' for layer
+        :param point_object: Django Point Object to be adjusted
+        :return: Adjusted Point Object
+        """
+        x_offset, y_offset = self._get_upperleft_offset(layername)
+        x, y = point_object
+        return Point(x + x_offset, y + y_offset, srid=point_object.srid)
 
-    def get_tile(self, layername, zoom, tilex, tiley, extension=".png"):
+    def build_coverage_index(self, layername, zooms=None):
         """
-        :param layername: Needed to retrieve layer specific configuration
+        Build a TileCoverageIndex from the layer's data in a single pass,
+        and attach it to the layer's config so that get_tile() skips empty tiles.
+        :param layername: Defined in layers_config on initial instantiation.
+        :param zooms: zoom levels to index, by default down to the deepest zoom with tiles at least 'pixel_size' wide
+        :return: TileCoverageIndex instance
+        """
+        self._check_layer_configured(layername)
+        layer_config = self.layers_config[layername]
+        coverage_index = TileCoverageIndex(layer_config["pixel_size"], zooms=zooms)
+        if layer_config["layer_source"] is not None:
+            coverage_index.add_points(layer_config["layer_source"].iter_points())
+            layer_config["coverage_index"] = coverage_index
+            return coverage_index
+        queryset = layer_config["model_queryset"]
+        model_points = queryset.values_list(layer_config["model_point_fieldname"], flat=True)
+        for model_point in model_points.iterator():
+            if model_point.srid != SPHERICAL_MERCATOR_SRID:
+                model_point.transform(SPHERICAL_MERCATOR_SRID)
+            coverage_index.add_point(model_point.x, model_point.y)
+        layer_config["coverage_index"] = coverage_index
+        return coverage_index
+
+    def _get_meters_per_pixel(self, zoom, tilex, tiley, scale=1):
+        tile_xmin, tile_ymin, tile_xmax, tile_ymax = self.tile_sphericalmercator_extent(zoom, tilex, tiley)
+        tile_pixels_width, _ = self.tile_pixels(scale)
+        return (tile_xmax - tile_xmin) / tile_pixels_width
+
+    def _get_layer_queryset(self, layername, time_range=None):
+        """
+        :param layername: Defined in layers_config on initial instantiation.
+        :param time_range: (start, end) inclusive range applied to temporal layers,
+            a date-only end includes all of that day
+        :return: layer 'model_queryset', filtered by time_range for temporal layers
+        """
+        layer_config = self.layers_config[layername]
+        queryset = layer_config["model_queryset"]
+        time_fieldname = layer_config["model_time_fieldname"]
+        if time_range is not None and time_fieldname:
+            start, end, end_inclusive = get_time_range_bounds(time_range)
+            kwargs = {"{}__gte".format(time_fieldname): start,
+                      "{}__{}".format(time_fieldname, "lte" if end_inclusive else "lt"): end}
+            queryset = queryset.filter(**kwargs)
+        return queryset
+
+    def _get_pixel_bbox(self, pixel_xmin, pixel_ymin, pixel_width):
+        """
+        Round tile image pixel coords down (toward the upper-left), so that all 'query_strategy' values draw the same pixels
+        and pixels starting outside the tile are not drawn on the tile edge.
+        :param pixel_xmin: pixel upper-left x in tile image coords
+        :param pixel_ymin: pixel upper-left y in tile image coords
+        :param pixel_width: pixel width in tile image pixels
+        :return: (xmin, ymin, xmax, ymax) in tile image coords
+        """
+        return (floor(pixel_xmin),
+                floor(pixel_ymin),
+                floor(pixel_xmin + pixel_width),
+                floor(pixel_ymin + pixel_width))
+
+    def _get_tile_pixels(self, layername, zoom, tilex, tiley, time_range=None, scale=1):
+        """
+        Query the layer data for the given tile using the layer's 'query_strategy'
+        :param layername: Defined in layers_config on initial instantiation.
         :param zoom: Zoom Level
-        :param tilex: tile x value (upper left starts at 0)
-        :param tiley: tile y value (upper left starts at 0)
-        :param extension: image extension type
-        :return: (<mimetype>, <resulting tile image object>)
+        :param tilex: tile x value
+        :param tiley: tile y value
+        :param time_range: (start, end) inclusive range applied to temporal layers
+        :param scale: tile scale factor (ex: 2 for '@2x' tiles)
+        :return: iterable of (<pixel bbox (xmin, ymin, xmax, ymax) in tile image coords>, <model instance or row>)
         """
-        layer_config = self.layers_config.get(layername, None)
-        if not layer_config:
-            raise LayerNotConfigured("layers_config[{}] not found in: {}".format(layername, str(self.layers_config.keys())))
+        layer_config = self.layers_config[layername]
+        if layer_config["layer_source"] is not None:
+            return self._get_tile_pixels_source(layername, zoom, tilex, tiley, time_range, scale)
+        if layer_config["query_strategy"] == "raw":
+            return self._get_tile_pixels_raw(layername, zoom, tilex, tiley, time_range, scale)
+        return self._get_tile_pixels_model(layername, zoom, tilex, tiley, time_range, scale)
+
+    def _get_tile_pixels_model(self, layername, zoom, tilex, tiley, time_range=None, scale=1):
+        """
+        Retrieve model instances for the tile, filtering with the 'within' or 'bboverlaps' lookup.
+        """
+        layer_config = self.layers_config[layername]
+        pixel_size = layer_config["pixel_size"]
+        point_fieldname = layer_config["model_point_fieldname"]
 
         # get tile extents in SPHERICAL_MERCATOR_SRID
         # (xmin, ymin, xmax, ymax)
         tile_xmin, tile_ymin, tile_xmax, tile_ymax = self.tile_sphericalmercator_extent(zoom, tilex, tiley)
-        tile_bbox = Polygon.from_bbox((tile_xmin, tile_ymin, tile_xmax, tile_ymax))
-        tile_bbox.srid = SPHERICAL_MERCATOR_SRID
-        # expand tile_bbox by 1 pixel(bin_size) to assure edge data is included
-        buffered_bbox = tile_bbox.buffer(layer_config["pixel_size"], quadsegs=2)
-
-        # start drawing each block
-        tile_image = Image.new("RGBA",
-                               (self.tile_pixels_width, self.tile_pixels_height),
-                               (255, 255, 255, 0))
-        draw = ImageDraw.Draw(tile_image)
-
-        # get layer legend instance
-        legend = layer_config["legend_instance"]
+        if layer_config["query_strategy"] == "bboverlaps":
+            # expand tile envelope by 1 pixel(bin_size) to assure edge data is included,
+            # the bounding box overlap ('&&' in PostGIS) test is resolved by the spatial index alone
+            envelope = Polygon.from_bbox((tile_xmin - pixel_size,
+                                          tile_ymin - pixel_size,
+                                          tile_xmax + pixel_size,
+                                          tile_ymax + pixel_size))
+            envelope.srid = SPHERICAL_MERCATOR_SRID
+            kwargs = {"{}__bboverlaps".format(point_fieldname): envelope, }
+        else:
+            tile_bbox = Polygon.from_bbox((tile_xmin, tile_ymin, tile_xmax, tile_ymax))
+            tile_bbox.srid = SPHERICAL_MERCATOR_SRID
+            # expand tile_bbox by 1 pixel(bin_size) to assure edge data is included
+            buffered_bbox = tile_bbox.buffer(pixel_size, quadsegs=2)
+            kwargs = {"{}__within".format(point_fieldname): buffered_bbox, }
 
         # get & process pixel data in attached model
-        kwargs = {"{}__within".format(layer_config["model_point_fieldname"]): buffered_bbox, }
-        queryset = layer_config["model_queryset"]
-        model_instance_pixel_data = queryset.filter(**kwargs)
-        for model_instance in model_instance_pixel_data:
-            color_str = legend.get_color_str(model_instance,
-                                             model_value_fieldname=layer_config["model_value_fieldname"])
-            model_point = getattr(model_instance, layer_config["model_point_fieldname"])
+        queryset = self._get_layer_queryset(layername, time_range).filter(**kwargs)
+        if layer_config["model_only_fields"]:
+            # the point, value & time fields are always needed to draw the tile
+            only_fields = list(layer_config["model_only_fields"])
+            for fieldname in (point_fieldname,
+                              layer_config["model_value_fieldname"],
+                              layer_config["model_time_fieldname"]):
+                if fieldname and fieldname not in only_fields:
+                    only_fields.append(fieldname)
+            queryset = queryset.only(*only_fields)
+        self._record_query(queryset.query)
+
+        meters_per_pixel = self._get_meters_per_pixel(zoom, tilex, tiley, scale)
+        for model_instance in queryset:
+            model_point = getattr(model_instance, point_fieldname)
             # pixel x, y expected to be in spherical-mercator
             # attempt to transform, note if srid is not defined this will generate an error
             if model_point.srid != SPHERICAL_MERCATOR_SRID:
@@ -159,23 +319,494 @@ class DjangoRasterTileLayerManager(RasterTileManager):
             # adjust to upper-left/nw
             upperleft_point = self._adjust_point_to_upperleft(layername, model_point)
 
-            # (xmin, ymin, xmax, ymax)
-            sphericalmercator_bbox = (upperleft_point.x ,
-                                      upperleft_point.y - layer_config["pixel_size"],
-                                      upperleft_point.x + layer_config["pixel_size"],
-                                      upperleft_point.y)
             # transform pixel spherical-mercator coords to image pixel coords
-            sphericalmercator_poly = Polygon.from_bbox(sphericalmercator_bbox)
-            if layer_config["round_pixels"]:
-                buffer_size = layer_config["pixel_size"] / 2.0
-                sphericalmercator_poly = sphericalmercator_poly.centroid.buffer(buffer_size)
+            # (xmin, ymin, xmax, ymax)
+            pixel_xmin = (upperleft_point.x - tile_xmin) / meters_per_pixel
+            pixel_ymin = (tile_ymax - upperleft_point.y) / meters_per_pixel
+            pixel_bbox = self._get_pixel_bbox(pixel_xmin, pixel_ymin, pixel_size / meters_per_pixel)
+            yield pixel_bbox, model_instance
+
+    def _get_raw_tile_query(self, layername, zoom, tilex, tiley, time_range=None, scale=1):
+        """
+        Build the SQL used by the 'raw' query strategy (PostGIS).
+        The layer's 'model_queryset', filtered by the tile envelope (expanded by 1 pixel) & time_range, is used as a subquery,
+        so the bounding box overlap test is applied to the model column and resolved by the spatial index.
+        :return: (sql, params, row_fieldnames)
+        """
+        layer_config = self.layers_config[layername]
+        pixel_size = layer_config["pixel_size"]
+        point_fieldname = layer_config["model_point_fieldname"]
+        row_fieldnames = [layer_config["model_value_fieldname"]]
+        if layer_config["model_time_fieldname"]:
+            row_fieldnames.append(layer_config["model_time_fieldname"])
+
+        tile_xmin, tile_ymin, tile_xmax, tile_ymax = self.tile_sphericalmercator_extent(zoom, tilex, tiley)
+        # expand tile envelope by 1 pixel(bin_size) to assure edge data is included
+        envelope = Polygon.from_bbox((tile_xmin - pixel_size,
+                                      tile_ymin - pixel_size,
+                                      tile_xmax + pixel_size,
+                                      tile_ymax + pixel_size))
+        envelope.srid = SPHERICAL_MERCATOR_SRID
+        queryset = self._get_layer_queryset(layername, time_range)
+        queryset = queryset.filter(**{"{}__bboverlaps".format(point_fieldname): envelope})
+        subquery_sql, subquery_params = queryset.values_list(point_fieldname, *row_fieldnames).query.sql_with_params()
+
+        quote_name = connections[queryset.db].ops.quote_name
+        model_meta = queryset.model._meta
+        # geometry columns are selected as bytea by the django PostGIS backend
+        point_column = "t.{}::geometry".format(quote_name(model_meta.get_field(point_fieldname).column))
+        row_columns = ", ".join("t.{}".format(quote_name(model_meta.get_field(fieldname).column))
+                                for fieldname in row_fieldnames)
+        sql = ("SELECT (ST_X(ST_Transform({point}, %s)) + %s - %s) / %s, "
+               "(%s - (ST_Y(ST_Transform({point}, %s)) + %s)) / %s, "
+               "{row_columns} "
+               "FROM ({subquery}) AS t").format(point=point_column, row_columns=row_columns, subquery=subquery_sql)
+        meters_per_pixel = self._get_meters_per_pixel(zoom, tilex, tiley, scale)
+        x_offset, y_offset = self._get_upperleft_offset(layername)
+        params = [SPHERICAL_MERCATOR_SRID, x_offset, tile_xmin, meters_per_pixel,
+                  tile_ymax, SPHERICAL_MERCATOR_SRID, y_offset, meters_per_pixel]
+        params.extend(subquery_params)
+        return sql, params, row_fieldnames
+
+    def _get_tile_pixels_raw(self, layername, zoom, tilex, tiley, time_range=None, scale=1):
+        """
+        Retrieve only the tile image pixel x/y and value, calculated in the database (PostGIS).
+        The layer's 'model_queryset' is used as a subquery, so any filters applied to it are kept.
+        Rows given to the legend only contain the layer's 'model_value_fieldname'
+        (and 'model_time_fieldname' for temporal layers) attributes.
+        """
+        sql, params, row_fieldnames = self._get_raw_tile_query(layername, zoom, tilex, tiley, time_range, scale)
+        self._record_query((sql, params))
+        queryset = self.layers_config[layername]["model_queryset"]
+        pixel_width = self.layers_config[layername]["pixel_size"] / self._get_meters_per_pixel(zoom, tilex, tiley, scale)
+        with connections[queryset.db].cursor() as cursor:
+            cursor.execute(sql, params)
+            for pixel_x, pixel_y, *row_values in cursor.fetchall():
+                pixel_bbox = self._get_pixel_bbox(pixel_x, pixel_y, pixel_width)
+                yield pixel_bbox, SimpleNamespace(**dict(zip(row_fieldnames, row_values)))
+
+    def _get_tile_pixels_source(self, layername, zoom, tilex, tiley, time_range=None, scale=1):
+        """
+        Read the tile's points from the layer's 'layer_source', only the source chunks intersecting the tile are read.
+        Rows given to the legend only contain the layer's 'model_value_fieldname'
+        (and 'model_time_fieldname' for temporal layers) attributes.
+        """
+        layer_config = self.layers_config[layername]
+        pixel_size = layer_config["pixel_size"]
+        value_fieldname = layer_config["model_value_fieldname"]
+        time_fieldname = layer_config["model_time_fieldname"]
+        tile_xmin, tile_ymin, tile_xmax, tile_ymax = self.tile_sphericalmercator_extent(zoom, tilex, tiley)
+        meters_per_pixel = self._get_meters_per_pixel(zoom, tilex, tiley, scale)
+        x_offset, y_offset = self._get_upperleft_offset(layername)
+        pixel_width = pixel_size / meters_per_pixel
+
+        # expand tile envelope by 1 pixel(bin_size) to assure edge data is included
+        chunks = layer_config["layer_source"].query(tile_xmin - pixel_size,
+                                                    tile_ymin - pixel_size,
+                                                    tile_xmax + pixel_size,
+                                                    tile_ymax + pixel_size,
+                                                    time_range=time_range)
+        for xs, ys, values, times in chunks:
+            # transform pixel spherical-mercator coords, adjusted to upper-left/nw, to image pixel coords
+            pixel_xmins = ((xs + x_offset - tile_xmin) / meters_per_pixel).tolist()
+            pixel_ymins = ((tile_ymax - (ys + y_offset)) / meters_per_pixel).tolist()
+            if times is not None and time_fieldname:
+                # datetime64 microseconds convert to datetime objects
+                times = times.astype("datetime64[us]").tolist()
+            else:
+                times = [None] * len(pixel_xmins)
+            for pixel_xmin, pixel_ymin, value, time_value in zip(pixel_xmins, pixel_ymins, values.tolist(), times):
+                pixel_bbox = self._get_pixel_bbox(pixel_xmin, pixel_ymin, pixel_width)
+                row = {value_fieldname: value}
+                if time_fieldname:
+                    row[time_fieldname] = time_value
+                yield pixel_bbox, SimpleNamespace(**row)
+
+    def _record_query(self, query):
+        if self.profiler is None:
+            return
+        capture = self.profiler.current()
+        if capture is not None:
+            capture.query = query
+
+    def _draw_pixel(self, draw, layer_config, pixel_bbox, color_str):
+        if layer_config["round_pixels"]:
+            draw.ellipse(pixel_bbox, fill=color_str)
+        else:
+            draw.rectangle(pixel_bbox, fill=color_str)
+
+    def _get_colored_tile_pixels(self, layername, zoom, tilex, tiley, time_range=None, scale=1):
+        """
+        :return: iterable of (<pixel bbox (xmin, ymin, xmax, ymax) in tile image coords>, <color_str>)
+        """
+        layer_config = self.layers_config[layername]
+
+        # skip query for tiles known to contain no data
+        coverage_index = layer_config["coverage_index"]
+        if coverage_index is not None and not coverage_index.covers(zoom, tilex, tiley):
+            return
+
+        # get layer legend instance
+        legend = layer_config["legend_instance"]
+
+        for pixel_bbox, model_instance in self._get_tile_pixels(layername, zoom, tilex, tiley, time_range, scale):
+            color_str = legend.get_color_str(model_instance,
+                                             model_value_fieldname=layer_config["model_value_fieldname"])
+            yield pixel_bbox, color_str
+
+    def _fetch_colored_tile_pixels(self, layername, zoom, tilex, tiley, time_range=None, scale=1):
+        """
+        Retrieve the colored tile pixels in a composite executor worker thread.
+        The thread's database connections are kept, and closed according to CONN_MAX_AGE (or when unusable),
+        as django does at the start & end of a request.
+        """
+        close_old_connections()
+        try:
+            return list(self._get_colored_tile_pixels(layername, zoom, tilex, tiley, time_range, scale))
+        finally:
+            close_old_connections()
+
+    def _get_composite_executor(self):
+        with self._composite_executor_lock:
+            if self._composite_executor is None:
+                self._composite_executor = ThreadPoolExecutor(max_workers=self.composite_workers,
+                                                              thread_name_prefix="tmstiler-composite")
+            return self._composite_executor
+
+    def close(self):
+        """
+        Shutdown the get_composite_tile() worker threads, waiting for queries in progress to complete.
+        """
+        with self._composite_executor_lock:
+            executor = self._composite_executor
+            self._composite_executor = None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def _check_layer_configured(self, layername):
+        if layername not in self.layers_config:
+            raise LayerNotConfigured("layers_config[{}] not found in: {}".format(layername, str(self.layers_config.keys())))
+
+    def _check_layer_temporal(self, layername):
+        if not self.layers_config[layername]["model_time_fieldname"]:
+            raise LayerNotTemporal("layers_config[{}] does not define 'model_time_fieldname'".format(layername))
+
+    def _new_tile_image(self, scale=1):
+        return Image.new("RGBA",
+                         self.tile_pixels(scale),
+                         (255, 255, 255, 0))
+
+    def get_tile(self, layername, zoom, tilex, tiley, extension=".png", time_range=None, scale=1):
+        """
+        :param layername: Needed to retrieve layer specific configuration
+        :param zoom: Zoom Level
+        :param tilex: tile x value (upper left starts at 0)
+        :param tiley: tile y value (upper left starts at 0)
+        :param extension: image extension type
+        :param time_range: (start, end) inclusive range of the temporal layer's 'model_time_fieldname' to render
+        :param scale: tile scale factor (ex: 2 for '@2x' tiles), resulting tile image is (tile_pixels_width * scale) wide
+        :return: (<mimetype>, <resulting tile image object>)
+        """
+        self._check_layer_configured(layername)
+        if time_range is not None:
+            self._check_layer_temporal(layername)
+        if self.profiler is None:
+            tile_image, _ = self._render_tile_image(layername, zoom, tilex, tiley, time_range, scale)
+        else:
+            with self.profiler.capture(layername, zoom, tilex, tiley) as capture:
+                tile_image, capture.row_count = self._render_tile_image(layername, zoom, tilex, tiley, time_range, scale)
+        return mimetypes.types_map.get(extension), tile_image
 
-            poly_coords = []
-            for sm_x, sm_y in sphericalmercator_poly.coords[0]:
-                px, py = self.sphericalmercator_to_pixel(zoom, tilex, tiley, sm_x, sm_y)
-                poly_coords.append((px, py))
+    def _render_tile_image(self, layername, zoom, tilex, tiley, time_range=None, scale=1):
+        """
+        :return: (<tile image object>, <number of pixels drawn>)
+        """
+        layer_config = self.layers_config[layername]
 
+        # start drawing each block
+        tile_image = self._new_tile_image(scale)
+        draw = ImageDraw.Draw(tile_image)
+        pixel_count = 0
+        for pixel_bbox, color_str in self._get_colored_tile_pixels(layername, zoom, tilex, tiley, time_range, scale):
             # draw pixel on tile
-            draw.polygon(poly_coords, fill=color_str)
+            self._draw_pixel(draw, layer_config, pixel_bbox, color_str)
+            pixel_count += 1
+        return tile_image, pixel_count
+
+    def get_composite_tile(self, layernames, zoom, tilex, tiley, extension=".png", blend_mode="alpha", time_range=None,
+                           scale=1):
+        """
+        Render multiple layers into a single tile.
+        Layer data is queried concurrently, the first layer in the calling thread
+        and the remaining layers in the manager's composite executor threads.
+        :param layernames: ordered layer names, the first layer is drawn at the bottom
+        :param zoom: Zoom Level
+        :param tilex: tile x value (upper left starts at 0)
+        :param tiley: tile y value (upper left starts at 0)
+        :param extension: image extension type
+        :param blend_mode: one of VALID_BLEND_MODES
+            "alpha": each layer is drawn separately and alpha composited (source-over) onto the previous layers (default)
+            "replace": layer pixels are drawn directly into a single image, replacing the pixels of previous layers
+                (including their alpha), faster for layers using opaque colors
+        :param time_range: (start, end) inclusive time range, applied to temporal layers only
+        :param scale: tile scale factor (ex: 2 for '@2x' tiles)
+        :return: (<mimetype>, <resulting tile image object>)
+        """
+        assert blend_mode in self.VALID_BLEND_MODES
+        if not layernames:
+            raise ValueError("get_composite_tile() requires at least 1 layer name")
+        for layername in layernames:
+            self._check_layer_configured(layername)
+
+        futures = []
+        if len(layernames) > 1:
+            executor = self._get_composite_executor()
+            futures = [executor.submit(self._fetch_colored_tile_pixels, layername, zoom, tilex, tiley, time_range, scale)
+                       for layername in layernames[1:]]
+        layers_pixels = [list(self._get_colored_tile_pixels(layernames[0], zoom, tilex, tiley, time_range, scale))]
+        layers_pixels.extend(future.result() for future in futures)
+
+        tile_image = self._new_tile_image(scale)
+        draw = ImageDraw.Draw(tile_image)
+        for layername, layer_pixels in zip(layernames, layers_pixels):
+            if not layer_pixels:
+                continue
+            layer_config = self.layers_config[layername]
+            if blend_mode == "alpha":
+                layer_image = self._new_tile_image(scale)
+                layer_draw = ImageDraw.Draw(layer_image)
+                for pixel_bbox, color_str in layer_pixels:
+                    self._draw_pixel(layer_draw, layer_config, pixel_bbox, color_str)
+                tile_image.alpha_composite(layer_image)
+            else:
+                for pixel_bbox, color_str in layer_pixels:
+                    self._draw_pixel(draw, layer_config, pixel_bbox, color_str)
 
         return mimetypes.types_map.get(extension), tile_image
+
+    def get_tile_frames(self, layername, zoom, tilex, tiley, time_range, extension=".png", scale=1):
+        """
+        Render the temporal layer's tile for each 'time_frame' in the given time range.
+        The data for all frames is retrieved with a single query, frames without data are blank.
+        :param layername: Needed to retrieve layer specific configuration
+        :param zoom: Zoom Level
+        :param tilex: tile x value (upper left starts at 0)
+        :param tiley: tile y value (upper left starts at 0)
+        :param time_range: (start, end) inclusive range of the layer's 'model_time_fieldname',
+            if None all data is rendered and only the frames containing data are included
+        :param extension: image extension type
+        :param scale: tile scale factor (ex: 2 for '@2x' tiles)
+        :return: (<mimetype>, [(<frame key, ex: "201410">, <frame tile image object>), ...]) ordered by frame key
+            NOTE: points with a null time are not drawn
+        """
+        self._check_layer_configured(layername)
+        self._check_layer_temporal(layername)
+        layer_config = self.layers_config[layername]
+        time_fieldname = layer_config["model_time_fieldname"]
+        frame_format = self.TIME_FRAME_FORMATS[layer_config["time_frame"]]
+
+        frames = {}
+        coverage_index = layer_config["coverage_index"]
+        if coverage_index is None or coverage_index.covers(zoom, tilex, tiley):
+            legend = layer_config["legend_instance"]
+            for pixel_bbox, model_instance in self._get_tile_pixels(layername, zoom, tilex, tiley, time_range, scale):
+                time_value = getattr(model_instance, time_fieldname)
+                if time_value is None:
+                    # not part of any time frame
+                    continue
+                frame_key = time_value.strftime(frame_format)
+                if frame_key not in frames:
+                    frame_image = self._new_tile_image(scale)
+                    frames[frame_key] = (frame_image, ImageDraw.Draw(frame_image))
+                _, draw = frames[frame_key]
+                color_str = legend.get_color_str(model_instance,
+                                                 model_value_fieldname=layer_config["model_value_fieldname"])
+                self._draw_pixel(draw, layer_config, pixel_bbox, color_str)
+
+        frame_keys = set(frames)
+        if time_range is not None:
+            frame_keys.update(frame_start.strftime(frame_format)
+                              for frame_start in get_time_frames(time_range, layer_config["time_frame"]))
+        tile_frames = [(frame_key, frames[frame_key][0] if frame_key in frames else self._new_tile_image(scale))
+                       for frame_key in sorted(frame_keys)]
+        return mimetypes.types_map.get(extension), tile_frames
+
+    def encode_frames(self, frame_images, extension=".png", duration=500):
+        """
+        Encode tile frames as a single animated image (APNG for ".png", or GIF for ".gif")
+        :param frame_images: list of tile image objects, as returned by get_tile_frames()
+        :param extension: image extension type
+        :param duration: display time of each frame in milliseconds
+        :return: (<mimetype>, <encoded animated image bytes>)
+        """
+        image_encoding = extension.replace(".", "")
+        if not frame_images:
+            frame_images = [self._new_tile_image()]
+        save_kwargs = {}
+        if image_encoding == "gif":
+            # restore to background, otherwise a blank frame keeps displaying the previous frame
+            save_kwargs["disposal"] = 2
+        image_fileio = BytesIO()
+        frame_images[0].save(image_fileio,
+                             image_encoding,
+                             save_all=True,
+                             append_images=frame_images[1:],
+                             duration=duration,
+                             loop=0,
+                             **save_kwargs)
+        return mimetypes.types_map.get(extension), image_fileio.getvalue()
+
+    def get_tile_cache_key(self, layername, zoom, tilex, tiley, extension=".png", scale=1):
+        """
+        :return: tile_cache key in the format, "<layername>/<zoom>/<tilex>/<tiley>[@<scale>x]<extension>"
+        """
+        scale_suffix = "@{}x".format(scale) if scale != 1 else ""
+        return "{}/{}/{}/{}{}{}".format(layername, zoom, tilex, tiley, scale_suffix, extension)
+
+    def encode_tile(self, tile_image, extension=".png"):
+        """
+        :param tile_image: tile image object, as returned by get_tile()
+        :param extension: image extension type
+        :return: encoded tile image bytes
+        """
+        image_encoding = extension.replace(".", "")  # change ".png" to just "png"
+        image_fileio = BytesIO()
+        tile_image.save(image_fileio, image_encoding)
+        return image_fileio.getvalue()
+
+    def render_tile(self, layername, zoom, tilex, tiley, extension=".png", scale=1):
+        """
+        Render & encode the tile, storing the result in the tile_cache (if defined)
+        :return: (<mimetype>, <encoded tile image bytes>)
+        """
+        mimetype, tile_image = self.get_tile(layername, zoom, tilex, tiley, extension=extension, scale=scale)
+        tile_bytes = self.encode_tile(tile_image, extension)
+        if self.tile_cache is not None:
+            key = self.get_tile_cache_key(layername, zoom, tilex, tiley, extension, scale)
+            self.tile_cache.set(key, tile_bytes)
+        return mimetype, tile_bytes
+
+    def get_encoded_tile(self, layername, zoom, tilex, tiley, extension=".png", scale=1):
+        """
+        Retrieve the encoded tile from the tile_cache, rendering the tile if not cached.
+        :param layername: Needed to retrieve layer specific configuration
+        :param zoom: Zoom Level
+        :param tilex: tile x value (upper left starts at 0)
+        :param tiley: tile y value (upper left starts at 0)
+        :param extension: image extension type
+        :param scale: tile scale factor (ex: 2 for '@2x' tiles)
+        :return: (<mimetype>, <encoded tile image bytes>)
+        """
+        if self.prefetcher is None:
+            return self._get_encoded_tile(layername, zoom, tilex, tiley, extension, scale)
+        with self.prefetcher.foreground():
+            result = self._get_encoded_tile(layername, zoom, tilex, tiley, extension, scale)
+        self.prefetcher.schedule(layername, zoom, tilex, tiley, extension, scale)
+        return result
+
+    def _get_encoded_tile(self, layername, zoom, tilex, tiley, extension=".png", scale=1):
+        if self.tile_cache is not None:
+            key = self.get_tile_cache_key(layername, zoom, tilex, tiley, extension, scale)
+            tile_bytes = self.tile_cache.get(key)
+            if tile_bytes is not None:
+                return mimetypes.types_map.get(extension), tile_bytes
+        return self.render_tile(layername, zoom, tilex, tiley, extension, scale)
+
+    def get_pixel_extent(self, layername, xm, ym):
+        """
+        Calculate the Spherical Mercator extent of the pixel drawn for the given layer point
+        :param layername: Defined in layers_config on initial instantiation.
+        :param xm: point X in Spherical Mercator (meters)
+        :param ym: point Y in Spherical Mercator (meters)
+        :return: (minx, miny, maxx, maxy)
+        """
+        pixel_size = self.layers_config[layername]["pixel_size"]
+        x_offset, y_offset = self._get_upperleft_offset(layername)
+        upperleft_x = xm + x_offset
+        upperleft_y = ym + y_offset
+        return upperleft_x, upperleft_y - pixel_size, upperleft_x + pixel_size, upperleft_y
+
+    def _get_dirty_extent(self, layername, minx, miny, maxx, maxy):
+        """
+        Expand the extent of layer points by the 1 pixel(bin_size) edge buffer applied when querying a tile,
+        all tiles querying (and so possibly drawing) the points intersect the expanded extent.
+        The drawn pixel extent (get_pixel_extent()) of any 'point_position' is within the expanded extent.
+        """
+        pixel_size = self.layers_config[layername]["pixel_size"]
+        return minx - pixel_size, miny - pixel_size, maxx + pixel_size, maxy + pixel_size
+
+    def _get_invalidation_max_zoom(self, layername):
+        """
+        Deeper tiles are smaller than a layer pixel, and a changed point would dirty a rapidly growing number of them.
+        """
+        layer_config = self.layers_config[layername]
+        if layer_config["invalidation_max_zoom"] is not None:
+            return layer_config["invalidation_max_zoom"]
+        return self.get_deepest_zoom(layer_config["pixel_size"])
+
+    def invalidate_points(self, layername, points, dirty_tiles=None):
+        """
+        Mark the tiles drawing the given (added, changed or removed) layer points as dirty.
+        The layer's 'coverage_index' (if defined) is updated to include the points.
+        :param layername: Defined in layers_config on initial instantiation.
+        :param points: iterable of django Point objects, or (x, y) Spherical Mercator coordinates
+        :param dirty_tiles: DirtyTileSet to update, if not given a new DirtyTileSet is created
+        :return: DirtyTileSet
+        """
+        self._check_layer_configured(layername)
+        if dirty_tiles is None:
+            dirty_tiles = DirtyTileSet()
+        coverage_index = self.layers_config[layername]["coverage_index"]
+        max_zoom = self._get_invalidation_max_zoom(layername)
+        for point in points:
+            if isinstance(point, Point):
+                if point.srid != SPHERICAL_MERCATOR_SRID:
+                    point = point.transform(SPHERICAL_MERCATOR_SRID, clone=True)
+                point = (point.x, point.y)
+            xm, ym = point
+            dirty_tiles.add_extent(layername, *self._get_dirty_extent(layername, xm, ym, xm, ym), max_zoom=max_zoom)
+            if coverage_index is not None:
+                coverage_index.add_point(xm, ym)
+        return dirty_tiles
+
+    def invalidate_bbox(self, layername, minx, miny, maxx, maxy, dirty_tiles=None):
+        """
+        Mark the tiles drawing any layer point within the given Spherical Mercator bbox as dirty.
+        The layer's 'coverage_index' (if defined) is updated to include the bbox.
+        :param layername: Defined in layers_config on initial instantiation.
+        :param minx: bbox minimum X in Spherical Mercator (meters)
+        :param miny: bbox minimum Y in Spherical Mercator (meters)
+        :param maxx: bbox maximum X in Spherical Mercator (meters)
+        :param maxy: bbox maximum Y in Spherical Mercator (meters)
+        :param dirty_tiles: DirtyTileSet to update, if not given a new DirtyTileSet is created
+        :return: DirtyTileSet
+        """
+        self._check_layer_configured(layername)
+        if dirty_tiles is None:
+            dirty_tiles = DirtyTileSet()
+        dirty_tiles.add_extent(layername, *self._get_dirty_extent(layername, minx, miny, maxx, maxy),
+                               max_zoom=self._get_invalidation_max_zoom(layername))
+        coverage_index = self.layers_config[layername]["coverage_index"]
+        if coverage_index is not None:
+            coverage_index.add_extent(minx, miny, maxx, maxy)
+        return dirty_tiles
+
+    def render_dirty_tiles(self, dirty_tiles, extension=".png", scales=(1, )):
+        """
+        Re-render the dirty tiles held in the tile_cache, clearing the given DirtyTileSet.
+        Dirty tiles not in the tile_cache are skipped, they are rendered when next requested.
+        :param dirty_tiles: DirtyTileSet
+        :param extension: image extension type
+        :param scales: tile scale factors to render
+        :return: number of tiles rendered
+        """
+        assert self.tile_cache is not None
+        rendered_count = 0
+        for layername, zoom, tilex, tiley in dirty_tiles.pop_all():
+            for scale in scales:
+                key = self.get_tile_cache_key(layername, zoom, tilex, tiley, extension, scale)
+                if self.tile_cache.get(key) is None:
+                    continue
+                self.render_tile(layername, zoom, tilex, tiley, extension, scale)
+                rendered_count += 1
+        return rendered_count
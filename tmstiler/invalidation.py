@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+DirtyTileSet for tracking the tiles affected by layer data changes.
+Allows only the affected tiles to be re-rendered when layer data is updated.
+"""
+from .rtm import RasterTileManager
+
+
+DEFAULT_INVALIDATION_ZOOMS = range(0, 20)
+
+
+class DirtyTileSet:
+    """
+    Deduplicated set of (layername, zoom, tilex, tiley) tiles requiring re-rendering.
+    """
+
+    def __init__(self, zooms=DEFAULT_INVALIDATION_ZOOMS):
+        """
+        :param zooms: zoom levels to track
+        """
+        self.zooms = tuple(zooms)
+        self.tiles = set()
+        self.rtm = RasterTileManager()
+
+    def add_tile(self, layername, zoom, tilex, tiley):
+        self.tiles.add((layername, zoom, tilex, tiley))
+
+    def add_extent(self, layername, minx, miny, maxx, maxy, max_zoom=None):
+        """
+        Mark the tiles intersecting the given extent as dirty at all tracked zoom levels
+        :param layername: layer the extent applies to
+        :param minx: extent minimum X in Spherical Mercator (meters)
+        :param miny: extent minimum Y in Spherical Mercator (meters)
+        :param maxx: extent maximum X in Spherical Mercator (meters)
+        :param maxy: extent maximum Y in Spherical Mercator (meters)
+        :param max_zoom: optional deepest zoom level marked for the layer
+        """
+        for zoom in self.zooms:
+            if max_zoom is not None and zoom > max_zoom:
+                continue
+            for tilex, tiley in self.rtm.sphericalmercator_extent_to_tiles(zoom, minx, miny, maxx, maxy):
+                self.tiles.add((layername, zoom, tilex, tiley))
+
+    def pop_all(self):
+        """
+        :return: (list) dirty tiles, [(layername, zoom, tilex, tiley), ...] ordered by layername, zoom, tilex, tiley.
+            The set is cleared.
+        """
+        tiles = sorted(self.tiles)
+        self.tiles.clear()
+        return tiles
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def __iter__(self):
+        return iter(sorted(self.tiles))
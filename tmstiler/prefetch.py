@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""
+TilePrefetcher for rendering the tiles likely to be requested next into the tile layer manager's tile_cache.
+"""
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    from django.conf import settings
+    from django.db import close_old_connections, connections
+except ImportError:
+    settings = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class TileCacheMissing(Exception):
+    pass
+
+
+class TilePrefetcher:
+    """
+    Background tile renderer, attached to a tile layer manager with a 'tile_cache' (ex: DjangoRasterTileLayerManager):
+
+        tilemgr.prefetcher = TilePrefetcher(tilemgr, include_children=True)
+
+    After a tile is served by get_encoded_tile(), its neighbors (and optionally its 4 zoom + 1 children)
+    are queued and rendered into the tile_cache by the worker threads.
+    The queue is bounded, dropping the oldest queued tiles first, and queued tiles are deduplicated.
+    The most recently queued tiles are rendered first.
+    Workers wait while foreground tile requests are being processed.
+    Failed cache lookups & renders are logged, and the tile is rendered on request instead.
+    """
+
+    def __init__(self, tilemgr, workers=1, max_queue_size=256, include_children=False, max_zoom=19):
+        """
+        :param tilemgr: tile layer manager instance, providing 'render_tile()', 'get_tile_cache_key()' and 'tile_cache'
+        :param workers: number of worker threads
+        :param max_queue_size: maximum number of queued tiles
+        :param include_children: if True, the 4 zoom + 1 child tiles are also queued
+        :param max_zoom: child tiles are not queued beyond this zoom level
+        """
+        if getattr(tilemgr, "tile_cache", None) is None:
+            raise TileCacheMissing("TilePrefetcher requires a tile layer manager with a 'tile_cache'")
+        self.tilemgr = tilemgr
+        self.max_queue_size = max_queue_size
+        self.include_children = include_children
+        self.max_zoom = max_zoom
+        self.pending = OrderedDict()
+        self._foreground_count = 0
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    @contextmanager
+    def foreground(self):
+        """
+        Context manager marking a foreground tile request, workers do not start rendering while inside.
+        """
+        with self._condition:
+            self._foreground_count += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._foreground_count -= 1
+                self._condition.notify_all()
+
+    def _enqueue(self, tile):
+        if tile in self.pending:
+            self.pending.move_to_end(tile)
+            return
+        self.pending[tile] = None
+        if len(self.pending) > self.max_queue_size:
+            self.pending.popitem(last=False)
+
+    def schedule(self, layername, zoom, tilex, tiley, extension=".png", scale=1):
+        """
+        Queue the neighbor (and child) tiles of the served tile.
+        :param layername: layer name of the served tile
+        :param zoom: Zoom Level of the served tile
+        :param tilex: tile x value of the served tile
+        :param tiley: tile y value of the served tile
+        :param extension: image extension type
+        :param scale: tile scale factor (ex: 2 for '@2x' tiles)
+        """
+        tiles = []
+        if self.include_children and zoom < self.max_zoom:
+            for child_tilex, child_tiley in self.tilemgr.get_child_tiles(zoom, tilex, tiley):
+                tiles.append((layername, zoom + 1, child_tilex, child_tiley, extension, scale))
+        # neighbors are queued last, to be rendered first
+        for neighbor_tilex, neighbor_tiley in self.tilemgr.get_neighbor_tiles(zoom, tilex, tiley):
+            tiles.append((layername, zoom, neighbor_tilex, neighbor_tiley, extension, scale))
+        with self._condition:
+            if self._stopped:
+                return
+            for tile in tiles:
+                self._enqueue(tile)
+            self._condition.notify_all()
+
+    def cancel(self, layername=None):
+        """
+        Remove queued tiles, tiles already being rendered are completed.
+        :param layername: if given only tiles of the layer are removed
+        """
+        with self._condition:
+            if layername is None:
+                self.pending.clear()
+            else:
+                for tile in [tile for tile in self.pending if tile[0] == layername]:
+                    del self.pending[tile]
+
+    def stop(self, timeout=None):
+        """
+        Cancel queued tiles and stop the worker threads
+        :param timeout: seconds to wait for each worker thread to complete
+        """
+        with self._condition:
+            self._stopped = True
+            self.pending.clear()
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _next_tile(self):
+        with self._condition:
+            while not self._stopped and (not self.pending or self._foreground_count):
+                self._condition.wait()
+            if self._stopped:
+                return None
+            tile, _ = self.pending.popitem(last=True)
+            return tile
+
+    def _worker(self):
+        try:
+            while True:
+                tile = self._next_tile()
+                if tile is None:
+                    break
+                layername, zoom, tilex, tiley, extension, scale = tile
+                key = self.tilemgr.get_tile_cache_key(layername, zoom, tilex, tiley, extension, scale)
+                try:
+                    if self.tilemgr.tile_cache.get(key) is not None:
+                        continue
+                    # like a django request, discard connections left unusable or past CONN_MAX_AGE
+                    self._close_old_connections()
+                    try:
+                        self.tilemgr.render_tile(layername, zoom, tilex, tiley, extension, scale)
+                    finally:
+                        self._close_old_connections()
+                except Exception:
+                    # the tile is rendered on request instead
+                    logger.exception("prefetch of {} failed".format(key))
+        finally:
+            self._close_connections()
+
+    def _close_old_connections(self):
+        if settings is not None and settings.configured:
+            close_old_connections()
+
+    def _close_connections(self):
+        if settings is not None and settings.configured:
+            connections.close_all()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+"""
+TileProfiler for capturing profiles of slow (or sampled) tile renders.
+"""
+import cProfile
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+
+class TileRenderCapture:
+    """
+    Profile data collected for a single tile render.
+    """
+
+    def __init__(self, layername, zoom, tilex, tiley):
+        self.layername = layername
+        self.zoom = zoom
+        self.tilex = tilex
+        self.tiley = tiley
+        self.row_count = None
+        # django Query object, or (sql, params)
+        self.query = None
+        self.thread_id = threading.get_ident()
+        self.start = time.perf_counter()
+        self.elapsed = None
+        self.profile = None
+        self.stacks = Counter()
+
+    @property
+    def sql(self):
+        if self.query is None:
+            return None
+        if isinstance(self.query, tuple):
+            sql, params = self.query
+            return "{} -- params: {}".format(sql, params)
+        return str(self.query)
+
+
+class TileProfiler:
+    """
+    Captures the profile of tile renders exceeding 'threshold' seconds, and of a 'sample_rate' fraction of all renders.
+
+    Sampled renders are profiled with cProfile, written as '<capture name>.prof' (load with pstats, snakeviz, etc).
+    Slow renders are profiled by sampling the rendering thread's stack every 'sample_interval' seconds
+    once the threshold is exceeded, written as '<capture name>.folded' collapsed stacks (load with flamegraph.pl, speedscope, etc).
+    Capture details (layer/z/x/y, elapsed, row count and SQL) are written as '<capture name>.json'.
+    Only the most recent 'max_captures' captures are kept in the directory.
+
+    Renders that are not sampled and complete within the threshold only register/unregister the render.
+    The stack sampling thread is started on the first render, and waits without polling
+    until a registered render reaches the threshold. Call close() to stop the thread.
+    """
+
+    def __init__(self, directory, threshold=1.0, sample_rate=0.0, sample_interval=0.01, max_captures=100):
+        """
+        :param directory: capture output directory
+        :param threshold: render seconds after which the render is captured, None to disable
+        :param sample_rate: fraction (0.0 - 1.0) of renders to capture with cProfile
+        :param sample_interval: seconds between stack samples of renders exceeding the threshold
+        :param max_captures: number of captures kept in the directory
+        """
+        self.directory = directory
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.sample_interval = sample_interval
+        self.max_captures = max_captures
+        os.makedirs(directory, exist_ok=True)
+        self._active = {}
+        self._condition = threading.Condition()
+        self._rotate_lock = threading.Lock()
+        self._closed = False
+        self._watchdog = None
+
+    def close(self):
+        """
+        Stop the stack sampling thread, renders in progress are no longer stack sampled.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self._watchdog is not None:
+            self._watchdog.join()
+
+    def current(self):
+        """
+        :return: TileRenderCapture of the render in progress in the current thread, or None
+        """
+        return self._active.get(threading.get_ident())
+
+    @contextmanager
+    def capture(self, layername, zoom, tilex, tiley):
+        """
+        Context manager profiling the tile render within
+        :return: TileRenderCapture
+        """
+        capture = TileRenderCapture(layername, zoom, tilex, tiley)
+        if self.sample_rate and random.random() < self.sample_rate:
+            capture.profile = cProfile.Profile()
+            try:
+                capture.profile.enable()
+            except ValueError:
+                # another profiler is active
+                capture.profile = None
+        with self._condition:
+            if self.threshold is not None and not self._closed:
+                if self._watchdog is None:
+                    self._watchdog = threading.Thread(target=self._sample_stacks, daemon=True)
+                    self._watchdog.start()
+                if not self._active:
+                    # watchdog waits for a render to be registered
+                    self._condition.notify_all()
+            self._active[capture.thread_id] = capture
+        try:
+            yield capture
+        finally:
+            if capture.profile is not None:
+                capture.profile.disable()
+            with self._condition:
+                del self._active[capture.thread_id]
+            capture.elapsed = time.perf_counter() - capture.start
+            if capture.profile is not None or (self.threshold is not None and capture.elapsed >= self.threshold):
+                self._write(capture)
+
+    def _wait_for_slow_captures(self):
+        """
+        Wait until a registered render exceeds the threshold
+        :return: (list) TileRenderCapture objects exceeding the threshold, or None when closed
+        """
+        with self._condition:
+            while not self._closed:
+                if not self._active:
+                    self._condition.wait()
+                    continue
+                now = time.perf_counter()
+                slow_captures = [capture for capture in self._active.values() if now - capture.start >= self.threshold]
+                if slow_captures:
+                    return slow_captures
+                # renders registered later reach the threshold later, no notify is needed for them
+                earliest_start = min(capture.start for capture in self._active.values())
+                self._condition.wait(earliest_start + self.threshold - now)
+            return None
+
+    def _sample_stacks(self):
+        while True:
+            slow_captures = self._wait_for_slow_captures()
+            if slow_captures is None:
+                break
+            frames = sys._current_frames()
+            for capture in slow_captures:
+                frame = frames.get(capture.thread_id)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{}:{}:{}".format(os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+                    frame = frame.f_back
+                capture.stacks[";".join(reversed(stack))] += 1
+            del frames
+            with self._condition:
+                if not self._closed:
+                    self._condition.wait(self.sample_interval)
+
+    def _write(self, capture):
+        now = time.time()
+        capture_name = "{}{:06d}_{}_{}_{}_{}".format(time.strftime("%Y%m%d%H%M%S", time.localtime(now)),
+                                                     int((now % 1) * 1000000),
+                                                     capture.layername,
+                                                     capture.zoom,
+                                                     capture.tilex,
+                                                     capture.tiley).replace(os.sep, "_")
+        base_path = os.path.join(self.directory, capture_name)
+        details = {"layername": capture.layername,
+                   "zoom": capture.zoom,
+                   "tilex": capture.tilex,
+                   "tiley": capture.tiley,
+                   "elapsed": capture.elapsed,
+                   "row_count": capture.row_count,
+                   "sql": capture.sql,
+                   "sampled": capture.profile is not None,
+                   "stack_samples": 0}
+        if capture.profile is not None:
+            capture.profile.dump_stats(base_path + ".prof")
+        # copy, the watchdog thread may still be adding a sample
+        stacks = dict(capture.stacks)
+        if stacks:
+            details["stack_samples"] = sum(stacks.values())
+            with open(base_path + ".folded", "w") as folded_file:
+                for stack, count in stacks.items():
+                    folded_file.write("{} {}\n".format(stack, count))
+        with open(base_path + ".json", "w") as details_file:
+            json.dump(details, details_file, indent=2)
+        self._rotate()
+
+    def _rotate(self):
+        with self._rotate_lock:
+            capture_names = sorted(filename[:-len(".json")] for filename in os.listdir(self.directory)
+                                   if filename.endswith(".json"))
+            for capture_name in capture_names[:-self.max_captures]:
+                for extension in (".json", ".prof", ".folded"):
+                    try:
+                        os.remove(os.path.join(self.directory, capture_name + extension))
+                    except FileNotFoundError:
+                        pass
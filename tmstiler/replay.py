@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+"""
+TileReplayHarness for replaying recorded (or synthesized) tile requests against a tile layer manager in-process.
+Reports throughput, latency percentiles per zoom, query counts and tile cache hit rates.
+
+The tile layer manager's data source is used as-is, no database or layer data fixture is provided.
+For local runs, either:
+    - point the django DATABASES setting at a SpatiaLite (or PostGIS) copy of the layer data,
+      SpatiaLite supports the "within" & "bboverlaps" query strategies, the "raw" query strategy is PostGIS only
+    - define the replayed layers with a "layer_source" (tmstiler.columnar.ColumnarLayerSource),
+      read from local files without a database (query counts are 0)
+"""
+import queue
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+from math import ceil
+
+
+ACCESS_LOG_REQUEST_PATTERN = re.compile(r'"(?:GET|HEAD) (\S+)')
+
+
+def read_access_log(fileobj, path_filter=None):
+    """
+    Read the requested tile URLs from an access log in the common/combined log format.
+    :param fileobj: readable (text) file object
+    :param path_filter: optional regex string, only matching URLs are returned (ex: r"\\.png")
+    :return: (list) requested URLs, in log order
+    """
+    path_pattern = re.compile(path_filter) if path_filter else None
+    urls = []
+    for line in fileobj:
+        match = ACCESS_LOG_REQUEST_PATTERN.search(line)
+        if not match:
+            continue
+        url = match.group(1)
+        if path_pattern and not path_pattern.search(url):
+            continue
+        urls.append(url)
+    return urls
+
+
+def synthesize_sessions(rtm, layername, hotspots, zoom_weights, session_count=100, steps_per_session=10,
+                        viewport_tiles=3, extension=".png", seed=None):
+    """
+    Generate tile URLs for user pan/zoom map sessions, skewed toward the given hotspots and zoom levels.
+    Each session starts at a hotspot, and at each step pans one tile or zooms in/out one level,
+    requesting the (viewport_tiles x viewport_tiles) tiles of the viewport.
+    :param rtm: RasterTileManager instance
+    :param layername: layer name used in the generated URLs
+    :param hotspots: [(lon, lat, weight), ...] session start locations
+    :param zoom_weights: {<zoom>: <weight>, ...} session start zoom levels
+    :param session_count: number of sessions
+    :param steps_per_session: number of viewports requested in each session
+    :param viewport_tiles: viewport width/height in tiles
+    :param extension: image extension type
+    :param seed: random seed, for reproducible sessions
+    :return: (list) tile URLs, in the format '/<layername>/<zoom>/<x>/<y>.png'
+    """
+    rng = random.Random(seed)
+    zooms = sorted(zoom_weights)
+    urls = []
+    for _ in range(session_count):
+        lon, lat, _ = rng.choices(hotspots, weights=[weight for _, _, weight in hotspots])[0]
+        zoom = rng.choices(zooms, weights=[zoom_weights[z] for z in zooms])[0]
+        center_x, center_y = rtm.lonlat_to_tile(zoom, lon, lat)
+        for _ in range(steps_per_session):
+            max_tiles, _ = rtm.tiles_per_dimension(zoom)
+            for x_offset in range(-(viewport_tiles // 2), viewport_tiles - (viewport_tiles // 2)):
+                for y_offset in range(-(viewport_tiles // 2), viewport_tiles - (viewport_tiles // 2)):
+                    tilex = center_x + x_offset
+                    tiley = center_y + y_offset
+                    if 0 <= tilex < max_tiles and 0 <= tiley < max_tiles:
+                        # lonlat_to_tile() y starts from the top, convert to TMS y
+                        tms_tiley = max_tiles - 1 - tiley
+                        urls.append("/{}/{}/{}/{}{}".format(layername, zoom, tilex, tms_tiley, extension))
+            action = rng.choice(("pan", "pan", "pan", "zoomin", "zoomout"))
+            if action == "zoomin" and zoom < 19:
+                zoom += 1
+                center_x *= 2
+                center_y *= 2
+            elif action == "zoomout" and zoom > 0:
+                zoom -= 1
+                center_x //= 2
+                center_y //= 2
+            else:
+                center_x += rng.choice((-1, 0, 1))
+                center_y += rng.choice((-1, 0, 1))
+    return urls
+
+
+def percentile(sorted_values, percent):
+    """
+    :param sorted_values: sorted list of values
+    :param percent: (0-100)
+    :return: nearest-rank percentile value, None for an empty list
+    """
+    if not sorted_values:
+        return None
+    rank = max(ceil(percent / 100.0 * len(sorted_values)), 1)
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class ReplayReport:
+
+    def __init__(self, elapsed, latencies, query_counts, errors, cache_hits, cache_misses):
+        """
+        :param elapsed: total run time in seconds
+        :param latencies: {<zoom>: [<request seconds>, ...], ...}
+        :param query_counts: {<zoom>: <database query count>, ...}, None if queries are not counted
+        :param errors: [(<url>, <exception>), ...]
+        :param cache_hits: tile_cache hit count
+        :param cache_misses: tile_cache miss count
+        """
+        self.elapsed = elapsed
+        self.latencies = {zoom: sorted(values) for zoom, values in latencies.items()}
+        self.query_counts = query_counts
+        self.errors = errors
+        self.cache_hits = cache_hits
+        self.cache_misses = cache_misses
+
+    @property
+    def request_count(self):
+        return sum(len(values) for values in self.latencies.values())
+
+    @property
+    def throughput(self):
+        """
+        :return: requests per second
+        """
+        return self.request_count / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def cache_hit_rate(self):
+        lookups = self.cache_hits + self.cache_misses
+        return self.cache_hits / lookups if lookups else None
+
+    def zoom_summary(self, zoom):
+        """
+        :return: {"count": <requests>, "p50": <seconds>, "p95": <seconds>, "p99": <seconds>, "queries": <count>}
+        """
+        values = self.latencies.get(zoom, [])
+        queries = self.query_counts.get(zoom, 0) if self.query_counts is not None else None
+        return {"count": len(values),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "p99": percentile(values, 99),
+                "queries": queries}
+
+    def format(self):
+        """
+        :return: (str) text report
+        """
+        lines = ["requests: {}  errors: {}  elapsed: {:.2f}s  throughput: {:.1f} req/s".format(self.request_count,
+                                                                                           len(self.errors),
+                                                                                           self.elapsed,
+                                                                                           self.throughput)]
+        if self.cache_hit_rate is not None:
+            lines.append("cache hits: {}  misses: {}  hit rate: {:.1%}".format(self.cache_hits,
+                                                                             self.cache_misses,
+                                                                             self.cache_hit_rate))
+        lines.append("{:>4} {:>8} {:>9} {:>9} {:>9} {:>8}".format("zoom", "count", "p50(ms)", "p95(ms)", "p99(ms)",
+                                                                   "queries"))
+        for zoom in sorted(self.latencies):
+            summary = self.zoom_summary(zoom)
+            lines.append("{:>4} {:>8} {:>9.1f} {:>9.1f} {:>9.1f} {:>8}".format(zoom,
+                                                                              summary["count"],
+                                                                              summary["p50"] * 1000,
+                                                                              summary["p95"] * 1000,
+                                                                              summary["p99"] * 1000,
+                                                                              "-" if summary["queries"] is None
+                                                                              else summary["queries"]))
+        return "\n".join(lines)
+
+
+class _CountingCache:
+    """
+    tile_cache wrapper counting get() hits & misses.
+    Only lookups made by threads within counting() are counted,
+    so lookups made by background threads (ex: TilePrefetcher workers) do not affect the replay hit rate.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def counting(self):
+        self._local.counting = True
+        try:
+            yield
+        finally:
+            self._local.counting = False
+
+    def get(self, key, default=None):
+        value = self.cache.get(key)
+        if getattr(self._local, "counting", False):
+            with self._lock:
+                if value is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+        return default if value is None else value
+
+    def set(self, key, value):
+        self.cache.set(key, value)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+
+class TileReplayHarness:
+    """
+    Replay tile URLs against a tile layer manager (ex: DjangoRasterTileLayerManager).
+    URLs are routed with the manager's parse_url(), and rendered with get_encoded_tile() when available
+    (using the manager's tile_cache), otherwise get_tile().
+    The manager's layers must already be configured against a populated database (or a "layer_source"),
+    layers using the "raw" query strategy require PostGIS.
+    """
+
+    def __init__(self, tilemgr, concurrency=4, count_queries=True):
+        """
+        :param tilemgr: tile layer manager instance
+        :param concurrency: number of worker threads replaying requests
+        :param count_queries: count django database queries per zoom (ignored if django is not available)
+        """
+        self.tilemgr = tilemgr
+        self.concurrency = concurrency
+        self.count_queries = count_queries
+
+    def _request_tile(self, url):
+        layername, zoom, tilex, tiley, image_format = self.tilemgr.parse_url(url)
+        extension = ".{}".format(image_format)
+        scale = self.tilemgr.parse_url_scale(url)
+        if hasattr(self.tilemgr, "get_encoded_tile"):
+            self.tilemgr.get_encoded_tile(layername, zoom, tilex, tiley, extension=extension, scale=scale)
+        else:
+            self.tilemgr.get_tile(layername, zoom, tilex, tiley, extension=extension)
+        return zoom
+
+    def _worker(self, url_queue, latencies, query_counts, errors, lock, counting_cache=None):
+        connections = None
+        if query_counts is not None:
+            from django.db import connections
+
+        query_count = [0]
+
+        def count_query(execute, sql, params, many, context):
+            query_count[0] += 1
+            return execute(sql, params, many, context)
+
+        try:
+            while True:
+                try:
+                    url = url_queue.get_nowait()
+                except queue.Empty:
+                    break
+                query_count[0] = 0
+                start = time.perf_counter()
+                try:
+                    with ExitStack() as stack:
+                        if connections is not None:
+                            for alias in connections:
+                                stack.enter_context(connections[alias].execute_wrapper(count_query))
+                        if counting_cache is not None:
+                            stack.enter_context(counting_cache.counting())
+                        zoom = self._request_tile(url)
+                except Exception as e:
+                    with lock:
+                        errors.append((url, e))
+                    continue
+                elapsed = time.perf_counter() - start
+                with lock:
+                    latencies[zoom].append(elapsed)
+                    if query_counts is not None:
+                        query_counts[zoom] += query_count[0]
+        finally:
+            if connections is not None:
+                connections.close_all()
+
+    def run(self, urls):
+        """
+        :param urls: tile URLs to replay, ex: from read_access_log() or synthesize_sessions()
+        :return: ReplayReport
+        """
+        url_queue = queue.Queue()
+        for url in urls:
+            url_queue.put(url)
+        latencies = defaultdict(list)
+        query_counts = None
+        if self.count_queries:
+            try:
+                import django.db  # noqa: F401
+                query_counts = defaultdict(int)
+            except ImportError:
+                pass
+        errors = []
+        lock = threading.Lock()
+
+        original_tile_cache = getattr(self.tilemgr, "tile_cache", None)
+        counting_cache = None
+        if original_tile_cache is not None:
+            counting_cache = _CountingCache(original_tile_cache)
+            self.tilemgr.tile_cache = counting_cache
+        try:
+            start = time.perf_counter()
+            threads = [threading.Thread(target=self._worker,
+                                        args=(url_queue, latencies, query_counts, errors, lock, counting_cache))
+                       for _ in range(self.concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+        finally:
+            if counting_cache is not None:
+                self.tilemgr.tile_cache = original_tile_cache
+
+        return ReplayReport(elapsed,
+                            latencies,
+                            dict(query_counts) if query_counts is not None else None,
+                            errors,
+                            counting_cache.hits if counting_cache else 0,
+                            counting_cache.misses if counting_cache else 0)
@@ -1,34 +1,147 @@
-from math import radians, log, tan, cos, pi
-from urllib.parse import urlparse
+import datetime
+import re
+from math import radians, log, tan, cos, pi, ceil
+from urllib.parse import urlparse, parse_qs
+
+
+DATE_ONLY_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+MAX_ZOOM = 19
 
 
 class InvalidCoordinateForZoom(Exception):
     pass
 
 
+def get_time_range_bounds(time_range):
+    """
+    Convert an inclusive (start, end) time range to the bounds used to filter date/datetime values.
+    A date-only end (datetime.date or a 'YYYY-MM-DD' string) includes all of that day,
+    so that datetime values after midnight on the end date are not excluded.
+    :param time_range: (start, end) inclusive time range
+    :return: (start, end, end_inclusive)
+        for a date-only end, 'end' is the following day and 'end_inclusive' is False
+    """
+    start, end = time_range
+    end_date = None
+    if isinstance(end, datetime.date) and not isinstance(end, datetime.datetime):
+        end_date = end
+    elif isinstance(end, str) and DATE_ONLY_PATTERN.match(end):
+        end_date = datetime.datetime.strptime(end, "%Y-%m-%d").date()
+    if end_date is None:
+        return start, end, True
+    return start, end_date + datetime.timedelta(days=1), False
+
+
+def _as_datetime(value):
+    """
+    :param value: datetime, date or ISO 8601 string (ex: '2014-11-01', '2014-11-01T12:00')
+    """
+    if isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.date):
+        return datetime.datetime(value.year, value.month, value.day)
+    return datetime.datetime.fromisoformat(value)
+
+
+def get_time_frames(time_range, time_frame):
+    """
+    List the start of each 'time_frame' period within an inclusive (start, end) time range.
+    :param time_range: (start, end) inclusive time range
+    :param time_frame: one of TIME_FRAMES, "year", "month", "day" or "hour"
+    :return: [<datetime>, ...] ordered start of each period, the first period contains the range start
+    """
+    start, end, end_inclusive = get_time_range_bounds(time_range)
+    start = _as_datetime(start)
+    end = _as_datetime(end)
+    if time_frame == "year":
+        frame_start = start.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
+    elif time_frame == "month":
+        frame_start = start.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    elif time_frame == "day":
+        frame_start = start.replace(hour=0, minute=0, second=0, microsecond=0)
+    elif time_frame == "hour":
+        frame_start = start.replace(minute=0, second=0, microsecond=0)
+    else:
+        raise ValueError("Unknown time_frame: {}".format(time_frame))
+
+    frames = []
+    while frame_start < end or (end_inclusive and frame_start == end):
+        frames.append(frame_start)
+        if time_frame == "year":
+            frame_start = frame_start.replace(year=frame_start.year + 1)
+        elif time_frame == "month":
+            if frame_start.month == 12:
+                frame_start = frame_start.replace(year=frame_start.year + 1, month=1)
+            else:
+                frame_start = frame_start.replace(month=frame_start.month + 1)
+        elif time_frame == "day":
+            frame_start += datetime.timedelta(days=1)
+        else:
+            frame_start += datetime.timedelta(hours=1)
+    return frames
+
+
 class RasterTileManager:
 
-    def __init__(self):
+    def __init__(self, tile_pixels_width=256, tile_pixels_height=256):
+        """
+        :param tile_pixels_width: tile image width in pixels at scale 1 (ex: 256, 512)
+        :param tile_pixels_height: tile image height in pixels at scale 1 (only square tiles are supported)
+        """
         # About Spherical Mercator
         # http://docs.openlayers.org/library/spherical_mercator.html
         self.spherical_mercator_xmax = 20037508.34
         self.spherical_mercator_ymax = 20037508.34
         self.spherical_mercator_xmin = -20037508.34
         self.spherical_mercator_ymin = -20037508.34
-        self.tile_pixels_width = 256
-        self.tile_pixels_height = 256
+        self.tile_pixels_width = tile_pixels_width
+        self.tile_pixels_height = tile_pixels_height
 
     def parse_url(self, url):
         """
         Parse out the layername, zoom, x, y and image file format from given URL.
         :param url: url of map server in format: 'http://www.someserver.com/partofurl/layername/zoom/x/y.png'
+            (or 'y@2x.png' for scaled tiles, see parse_url_scale())
         :return: layername, x, y, z, tile image format (png/jpg)
         """
         result = urlparse(url)
         layername, z, x, ypart = result.path.rsplit("/", 4)[-4:]
         y, image_format = ypart.split(".")
+        y = y.split("@")[0]
         return layername, int(z), int(x), int(y), image_format
 
+    def parse_url_scale(self, url):
+        """
+        Parse out the tile scale factor from given URL.
+        :param url: url of map server in format: 'http://www.someserver.com/partofurl/layername/zoom/x/y@2x.png'
+        :return: (int) scale factor, 1 if not given
+        """
+        result = urlparse(url)
+        ypart = result.path.rsplit("/", 1)[-1]
+        y = ypart.split(".")[0]
+        if "@" not in y:
+            return 1
+        scale = y.split("@")[1].rstrip("x")
+        return int(scale)
+
+    def parse_url_time_range(self, url):
+        """
+        Parse out the time range from the 'time' query parameter of the given URL.
+        :param url: url of map server in format: 'http://www.someserver.com/partofurl/layername/zoom/x/y.png?time=<start>/<end>'
+            A single value, 'time=<value>', is returned as the range (<value>, <value>)
+        :return: (start, end) or None if the 'time' parameter is not given
+        """
+        result = urlparse(url)
+        time_values = parse_qs(result.query).get("time", None)
+        if not time_values:
+            return None
+        time_value = time_values[0]
+        if "/" in time_value:
+            start, end = time_value.split("/", 1)
+        else:
+            start = end = time_value
+        return start, end
+
     def lonlat_to_tile(self, zoom, lon, lat):
         """
         Return the tile coordinates for a given longitude, latitude and zoom level.
@@ -67,6 +180,20 @@ class RasterTileManager:
                 neighbor_tiles.append((new_tilex, new_tiley))
         return neighbor_tiles
 
+    def get_child_tiles(self, zoom, tilex, tiley):
+        """
+        Obtain the 4 tiles covering the given tile at the next zoom level (zoom + 1)
+        :param zoom: (int) zoom level
+        :param tilex: (int) tile x
+        :param tiley: (int) tile y
+        :return: (list) [(child_tilex, child_tiley), ...]
+        """
+        child_tiles = []
+        for x_offset in (0, 1):
+            for y_offset in (0, 1):
+                child_tiles.append((tilex * 2 + x_offset, tiley * 2 + y_offset))
+        return child_tiles
+
     def tile_sphericalmercator_extent(self, zoom, tilex, tiley):
         """
         Calculate the given tile's Spherical Mercator extent
@@ -96,7 +223,58 @@ class RasterTileManager:
         maxy = lowerleft_tile_cornery + meters_per_ytile_dimension
         return minx, miny, maxx, maxy
 
-    def sphericalmercator_to_pixel(self, zoom, tilex, tiley, xm, ym):
+    def sphericalmercator_to_tile(self, zoom, xm, ym):
+        """
+        Return the tile containing the given Spherical Mercator coordinate.
+        Coordinates outside of the Spherical Mercator extent are clamped to the edge tiles.
+        :param zoom: zoom level
+        :param xm: X in Spherical Mercator (meters)
+        :param ym: Y in Spherical Mercator (meters)
+        :return: tilex, tiley (TMS, tiley counted from the bottom, matching tile_sphericalmercator_extent())
+        """
+        xtiles_at_zoom, ytiles_at_zoom = self.tiles_per_dimension(zoom)
+        meters_per_xtile_dimension = (self.spherical_mercator_xmax + abs(self.spherical_mercator_xmin))/xtiles_at_zoom
+        meters_per_ytile_dimension = (self.spherical_mercator_ymax + abs(self.spherical_mercator_ymin))/ytiles_at_zoom
+        tilex = int((xm - self.spherical_mercator_xmin) // meters_per_xtile_dimension)
+        tiley = int((ym - self.spherical_mercator_ymin) // meters_per_ytile_dimension)
+        tilex = min(max(tilex, 0), xtiles_at_zoom - 1)
+        tiley = min(max(tiley, 0), ytiles_at_zoom - 1)
+        return tilex, tiley
+
+    def sphericalmercator_extent_to_tiles(self, zoom, minx, miny, maxx, maxy):
+        """
+        Obtain the tiles intersecting the given Spherical Mercator extent
+        :param zoom: zoom level
+        :param minx: extent minimum X in Spherical Mercator (meters)
+        :param miny: extent minimum Y in Spherical Mercator (meters)
+        :param maxx: extent maximum X in Spherical Mercator (meters)
+        :param maxy: extent maximum Y in Spherical Mercator (meters)
+        :return: (list) [(tilex, tiley), ...]
+            NOTE: tiles touching the extent edges are included
+        """
+        xtiles_at_zoom, ytiles_at_zoom = self.tiles_per_dimension(zoom)
+        meters_per_xtile_dimension = (self.spherical_mercator_xmax + abs(self.spherical_mercator_xmin))/xtiles_at_zoom
+        meters_per_ytile_dimension = (self.spherical_mercator_ymax + abs(self.spherical_mercator_ymin))/ytiles_at_zoom
+        # a minimum on a tile boundary also touches the tile below/left of the boundary
+        min_tilex = ceil((minx - self.spherical_mercator_xmin) / meters_per_xtile_dimension) - 1
+        min_tiley = ceil((miny - self.spherical_mercator_ymin) / meters_per_ytile_dimension) - 1
+        min_tilex = min(max(min_tilex, 0), xtiles_at_zoom - 1)
+        min_tiley = min(max(min_tiley, 0), ytiles_at_zoom - 1)
+        max_tilex, max_tiley = self.sphericalmercator_to_tile(zoom, maxx, maxy)
+        tiles = []
+        for tilex in range(min_tilex, max_tilex + 1):
+            for tiley in range(min_tiley, max_tiley + 1):
+                tiles.append((tilex, tiley))
+        return tiles
+
+    def tile_pixels(self, scale=1):
+        """
+        :param scale: tile scale factor (ex: 2 for '@2x' tiles)
+        :return: tile image width, height in pixels
+        """
+        return self.tile_pixels_width * scale, self.tile_pixels_height * scale
+
+    def sphericalmercator_to_pixel(self, zoom, tilex, tiley, xm, ym, scale=1):
         """
         Given a specific zoom & tile location,
         Reproject spherical-mercator value to raster x/y pixel values
@@ -105,15 +283,17 @@ class RasterTileManager:
         :param tiley: TMS tile Y
         :param xm: X in Spherical Mercator (meters)
         :param ym: Y in Spherical Mercator (meters)
+        :param scale: tile scale factor (ex: 2 for '@2x' tiles)
         :return: xp, yp (x, y raster pixel coordinates)
         """
         # get tile extents
         tile_minx, tile_miny, tile_maxx, tile_maxy = self.tile_sphericalmercator_extent(zoom, tilex, tiley)
+        tile_pixels_width, tile_pixels_height = self.tile_pixels(scale)
 
         tile_meters_x_width = tile_maxx - tile_minx
         tile_meters_y_height = tile_maxy - tile_miny
-        meters_per_xpixel = tile_meters_x_width/256
-        meters_per_ypixel = tile_meters_y_height/256
+        meters_per_xpixel = tile_meters_x_width/tile_pixels_width
+        meters_per_ypixel = tile_meters_y_height/tile_pixels_height
 
         # adjust xm & ym to max/min values, if they exceed the given tile
         if xm > tile_maxx:
@@ -133,13 +313,13 @@ class RasterTileManager:
         # invert y (for raster space)
         inverted_ym = shifted_ym - tile_meters_y_height
 
-        # convert from meters (0 - shifted_max) to pixels (0 - 256)
+        # convert from meters (0 - shifted_max) to pixels (0 - tile_pixels_width)
         xp = shifted_xm / meters_per_xpixel
         yp = abs(inverted_ym / meters_per_ypixel)
 
         # make sure pixels are in the expected range.
-        assert 0 <= xp <= 256
-        assert 0 <= yp <= 256
+        assert 0 <= xp <= tile_pixels_width
+        assert 0 <= yp <= tile_pixels_height
 
         return int(xp), int(yp)
 
@@ -154,3 +334,17 @@ class RasterTileManager:
         assert self.tile_pixels_height == self.tile_pixels_width
         return tile_count, tile_count
 
+
+    def get_deepest_zoom(self, pixel_size, max_zoom=MAX_ZOOM):
+        """
+        Deepest zoom level at which a tile is at least 'pixel_size' meters wide,
+        at deeper zoom levels a layer pixel spans multiple tiles.
+        :param pixel_size: pixel area size in meters
+        :param max_zoom: maximum zoom level returned
+        :return: zoom level
+        """
+        world_width = self.spherical_mercator_xmax - self.spherical_mercator_xmin
+        zoom = 0
+        while zoom < max_zoom and world_width / 2**(zoom + 1) >= pixel_size:
+            zoom += 1
+        return zoom